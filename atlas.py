@@ -0,0 +1,302 @@
+'''
+Author: leovt (Leonhard Vogt)
+License: GNU GENERAL PUBLIC LICENSE - Version 3, 29 June 2007
+
+Texture atlas for drawing many small images with few binds
+
+A TextureAtlas packs images into a few large textures, either separate
+GL_TEXTURE_2D pages or the layers of one GL_TEXTURE_2D_ARRAY. Each image
+gets a Region with its texture coordinates, so all images on a page can
+be drawn with a single bind and draw call.
+
+    atlas = TextureAtlas(512, 512)
+    region = atlas.add('icon', pixels, 16, 16)
+    vertices = rewrite_texcoords(vertices, region)
+
+Images can be added and removed at any time, the free space is managed
+by a guillotine rectangle packer.
+'''
+
+import collections
+from pyglet import gl
+
+import glhelper
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Packer:
+    '''
+    Guillotine rectangle packer.
+
+    A rectangle is placed into the free rectangle which leaves the
+    shortest side over, the rest of that free rectangle is split in two
+    along the shorter leftover axis. Freed rectangles are merged with
+    free neighbours sharing a whole edge.
+    '''
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.free = [(0, 0, width, height)]
+        self.used = 0
+
+    def insert(self, width, height):
+        '''
+        Reserve a rectangle and return its (x, y) position, or None
+        if it does not fit.
+        '''
+        best = None
+        for i, (x, y, w, h) in enumerate(self.free):
+            if width <= w and height <= h:
+                score = min(w - width, h - height)
+                if best is None or score < best[0]:
+                    best = (score, i)
+        if best is None:
+            return None
+
+        x, y, w, h = self.free.pop(best[1])
+        if w - width < h - height:
+            pieces = [(x + width, y, w - width, height), (x, y + height, w, h - height)]
+        else:
+            pieces = [(x + width, y, w - width, h), (x, y + height, width, h - height)]
+        self.free += [piece for piece in pieces if piece[2] > 0 and piece[3] > 0]
+        self.used += width * height
+        return x, y
+
+    def remove(self, x, y, width, height):
+        '''
+        Return a rectangle reserved by insert to the free space.
+        '''
+        self.used -= width * height
+        self.free.append((x, y, width, height))
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(self.free)):
+                for j in range(i + 1, len(self.free)):
+                    union = _union(self.free[i], self.free[j])
+                    if union:
+                        self.free[i] = union
+                        del self.free[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+    def occupancy(self):
+        return self.used / (self.width * self.height)
+
+
+def _union(a, b):
+    '''
+    Return the union of two rectangles if it is a rectangle, else None.
+    '''
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    if ax == bx and aw == bw and (ay + ah == by or by + bh == ay):
+        return (ax, min(ay, by), aw, ah + bh)
+    if ay == by and ah == bh and (ax + aw == bx or bx + bw == ax):
+        return (min(ax, bx), ay, aw + bw, ah)
+    return None
+
+
+class Region:
+    '''
+    The place of an image in a TextureAtlas.
+
+    texture is the Texture to bind, layer the array layer (0 for 2D
+    pages) and uv the (u0, v0, u1, v1) rectangle of the image.
+    '''
+    def __init__(self, key, texture, page, layer, x, y, width, height):
+        self.key = key
+        self.texture = texture
+        self.page = page
+        self.layer = layer
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.uv = (x / texture.width, y / texture.height,
+                   (x + width) / texture.width, (y + height) / texture.height)
+
+    def map_texcoords(self, texcoords):
+        '''
+        Map texture coordinates in [0, 1] relative to the image to
+        coordinates in the atlas texture.
+
+        Accepts a (n, k) numpy array or a sequence of tuples of k
+        coordinates. Only u and v are mapped. For array textures the
+        layer is written into the third coordinate, if there is one.
+        '''
+        u0, v0, u1, v1 = self.uv
+        if numpy is not None and isinstance(texcoords, numpy.ndarray):
+            mapped = numpy.array(texcoords, dtype=numpy.result_type(texcoords, numpy.float32))
+            mapped[..., :2] = texcoords[..., :2] * (u1 - u0, v1 - v0) + (u0, v0)
+            if self.texture.layers and mapped.shape[-1] > 2:
+                mapped[..., 2] = self.layer
+            return mapped
+        layer = (self.layer,) if self.texture.layers else ()
+        mapped = []
+        for texcoord in texcoords:
+            u, v = texcoord[:2]
+            rest = tuple(texcoord[2:])
+            if layer and rest:
+                rest = layer + rest[1:]
+            mapped.append((u0 + u * (u1 - u0), v0 + v * (v1 - v0)) + rest)
+        return mapped
+
+
+def rewrite_texcoords(vertices, region, field='texcoord', index=1):
+    '''
+    Return copy_program style vertices with the texture coordinates
+    mapped into region.
+
+    For structured numpy arrays the coordinates are taken from field,
+    for sequences of vertex tuples from the element at index.
+    '''
+    if numpy is not None and isinstance(vertices, numpy.ndarray):
+        vertices = vertices.copy()
+        vertices[field] = region.map_texcoords(vertices[field].astype(float))
+        return vertices
+    texcoords = region.map_texcoords([vertex[index] for vertex in vertices])
+    return [vertex[:index] + (texcoord,) + vertex[index + 1:]
+            for vertex, texcoord in zip(vertices, texcoords)]
+
+
+class TextureAtlas:
+    '''
+    Packs images into pages of width x height pixels.
+
+    With array=True all pages are layers of a single GL_TEXTURE_2D_ARRAY
+    texture allocated up front, so every image can be drawn with one bind
+    (the shader then samples with (u, v, layer)). Otherwise pages are
+    separate 2D textures created on demand, usable with copy_program.
+
+    padding pixels are left free around every image so linear filtering
+    does not bleed between neighbours. Regions are evicted least
+    recently used first when evict is set and the atlas is full.
+    '''
+    def __init__(self, width=1024, height=1024, internal_format=gl.GL_RGBA8, padding=1,
+                 array=False, max_pages=16, unit=0, uploader=None, on_evict=None):
+        self.width = width
+        self.height = height
+        self.internal_format = internal_format
+        self.padding = padding
+        self.max_pages = max_pages
+        self.unit = unit
+        self.uploader = uploader
+        self.on_evict = on_evict
+        self.packers = []
+        self.textures = []
+        self.regions = collections.OrderedDict()
+
+        self.array_texture = None
+        if array:
+            self.array_texture = glhelper.Texture(unit, gl.GL_TEXTURE_2D_ARRAY)
+            self.array_texture.allocate(width, height, internal_format, layers=max_pages)
+
+    def _add_page(self):
+        if self.array_texture:
+            texture = self.array_texture
+        else:
+            texture = glhelper.Texture(self.unit).allocate(self.width, self.height, self.internal_format)
+        self.packers.append(Packer(self.width, self.height))
+        self.textures.append(texture)
+
+    def _insert(self, width, height):
+        for page, packer in enumerate(self.packers):
+            position = packer.insert(width, height)
+            if position:
+                return page, position
+        if len(self.packers) < self.max_pages:
+            self._add_page()
+            position = self.packers[-1].insert(width, height)
+            if position:
+                return len(self.packers) - 1, position
+        return None
+
+
+    def add(self, key, data, width, height, pixel_format=gl.GL_RGBA,
+            pixel_type=gl.GL_UNSIGNED_BYTE, evict=False):
+        '''
+        Upload an image and return its Region. data holds tightly packed
+        rows of pixels as for Texture.upload.
+        '''
+        if key in self.regions:
+            self.remove(key)
+        padded = (width + 2 * self.padding, height + 2 * self.padding)
+        if padded[0] > self.width or padded[1] > self.height:
+            raise ValueError('Image of %dx%d pixels does not fit into the atlas.' % (width, height))
+        placement = self._insert(*padded)
+        while placement is None and evict and self.regions:
+            self.remove(next(iter(self.regions)), evicted=True)
+            placement = self._insert(*padded)
+        if placement is None:
+            raise ValueError('The texture atlas is full.')
+
+        page, (x, y) = placement
+        texture = self.textures[page]
+        layer = page if self.array_texture else 0
+        region = Region(key, texture, page, layer, x + self.padding, y + self.padding, width, height)
+        texture.upload(data, region.x, region.y, width, height, pixel_format, pixel_type,
+                       uploader=self.uploader, layer=layer)
+        self.regions[key] = region
+        return region
+
+
+    def remove(self, key, evicted=False):
+        '''
+        Free the space of an image. The pixels are left in the texture
+        until they are overwritten.
+        '''
+        region = self.regions.pop(key)
+        self.packers[region.page].remove(region.x - self.padding, region.y - self.padding,
+                                         region.width + 2 * self.padding, region.height + 2 * self.padding)
+        if evicted and self.on_evict:
+            self.on_evict(region)
+
+
+    def __getitem__(self, key):
+        '''
+        Return the Region of an image and mark it as recently used.
+        '''
+        self.regions.move_to_end(key)
+        return self.regions[key]
+
+    def __contains__(self, key):
+        return key in self.regions
+
+    def __len__(self):
+        return len(self.regions)
+
+
+    def uv(self, key):
+        return self[key].uv
+
+    def layer(self, key):
+        return self[key].layer
+
+    def release(self):
+        '''
+        Delete the textures of all pages.
+        '''
+        # the pages of an array atlas all share the array texture
+        for texture in set(self.textures) | ({self.array_texture} if self.array_texture else set()):
+            texture.release()
+        self.textures = []
+        self.packers = []
+        self.regions.clear()
+        self.array_texture = None
+
+    def by_texture(self, keys):
+        '''
+        Group image keys by the texture they are on, so each group can be
+        drawn with one bind.
+        '''
+        groups = collections.defaultdict(list)
+        for key in keys:
+            groups[self[key].texture].append(key)
+        return groups
@@ -0,0 +1,303 @@
+'''
+Author: leovt (Leonhard Vogt)
+License: GNU GENERAL PUBLIC LICENSE - Version 3, 29 June 2007
+
+Headless benchmark of the three example pipelines
+
+Renders a fixed number of frames through vertexbuffer.py, framebuffer.py
+and glhelper.py on an offscreen context, sweeping the vertex count, the
+number of draw calls per frame and the framebuffer size. The results are
+written as JSON so they can be compared between commits.
+
+    python benchmark.py --frames 200 --output results.json
+
+The context is created with pyglet's headless mode (EGL), which also works
+with Mesa llvmpipe on machines without a GPU.
+'''
+
+import sys
+import json
+import time
+import ctypes
+import argparse
+import platform
+
+import pyglet
+# must be set before pyglet.gl or pyglet.window are imported
+pyglet.options['headless'] = True
+pyglet.options['shadow_window'] = False
+from pyglet import gl
+
+import glprofile
+import vertexbuffer
+import framebuffer
+import glhelper
+
+
+def triangles(vertex_count):
+    '''
+    Return vertex_count vertices as ((x, y), (r, g, b, a)) tuples forming
+    small triangles spread over the viewport.
+    '''
+    vertices = []
+    for i in range(vertex_count // 3):
+        x = (i * 0.618034) % 1.8 - 0.9
+        y = (i * 0.414214) % 1.8 - 0.9
+        vertices += [((x, y), (1.0, 0.0, 0.0, 1.0)),
+                     ((x + 0.1, y), (0.0, 1.0, 0.0, 1.0)),
+                     ((x, y + 0.1), (0.0, 0.0, 1.0, 1.0))]
+    return vertices
+
+
+def delete_program(program):
+    '''
+    Delete a program of the raw examples together with its shaders.
+    '''
+    count = gl.GLsizei(0)
+    shaders = (gl.GLuint * 8)()
+    gl.glGetAttachedShaders(program, len(shaders), ctypes.byref(count), shaders)
+    for shader in shaders[:count.value]:
+        gl.glDeleteShader(shader)
+    gl.glDeleteProgram(program)
+
+
+class VertexbufferPipeline:
+    '''
+    The upload and draw calls of vertexbuffer.draw with a configurable vertex count.
+    '''
+    module = vertexbuffer
+    uses_framebuffer = False
+
+    def setup(self, width, height):
+        # vertexbuffer.py predates core profiles, which need a vertex array bound
+        vertex_array = gl.GLuint(0)
+        gl.glGenVertexArrays(1, ctypes.byref(vertex_array))
+        gl.glBindVertexArray(vertex_array)
+        program = vertexbuffer.setup_program()
+        vertexbuffer.setup_vertexbuffer(program)
+        self.objects = (vertex_array, program)
+
+    def teardown(self):
+        vertex_array, program = self.objects
+        gl.glBindVertexArray(0)
+        gl.glDeleteVertexArrays(1, ctypes.byref(vertex_array))
+        gl.glDeleteBuffers(1, ctypes.byref(vertexbuffer.vertexbuffer))
+        gl.glUseProgram(0)
+        delete_program(program)
+
+    def set_vertices(self, vertices):
+        self.data = (vertexbuffer.VERTEX * len(vertices))(*vertices)
+
+    def frame(self, draws):
+        gl.glClearColor(0.5, 0.6, 0.7, 1.0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, vertexbuffer.vertexbuffer)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, ctypes.sizeof(self.data), self.data, gl.GL_DYNAMIC_DRAW)
+        for i in range(draws):
+            gl.glDrawArrays(gl.GL_TRIANGLES, 0, len(self.data))
+
+
+class FramebufferPipeline:
+    '''
+    The calls of framebuffer.draw with a configurable vertex count.
+    '''
+    module = framebuffer
+    uses_framebuffer = True
+
+    def setup(self, width, height):
+        framebuffer.FB_WIDTH = width
+        framebuffer.FB_HEIGHT = height
+        framebuffer.setup_framebuffer()
+        framebuffer.setup_render_program()
+        framebuffer.setup_render_vertexbuffer()
+        framebuffer.setup_copy_program()
+        framebuffer.setup_copy_vertexbuffer()
+
+    def teardown(self):
+        gl.glBindVertexArray(0)
+        gl.glUseProgram(0)
+        for vertex_array in (framebuffer.render_vao, framebuffer.copy_vao):
+            gl.glDeleteVertexArrays(1, ctypes.byref(vertex_array))
+        for buffer in (framebuffer.render_vertexbuffer, framebuffer.copy_vertexbuffer,
+                       framebuffer.copy_indexbuffer):
+            gl.glDeleteBuffers(1, ctypes.byref(buffer))
+        delete_program(framebuffer.render_program)
+        delete_program(framebuffer.copy_program)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        gl.glDeleteFramebuffers(1, ctypes.byref(framebuffer.framebuffer))
+        gl.glDeleteTextures(1, ctypes.byref(framebuffer.rendered_texture))
+
+    def set_vertices(self, vertices):
+        self.data = (framebuffer.COLOR_VERTEX * len(vertices))(*vertices)
+
+    def frame(self, draws):
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, framebuffer.framebuffer)
+        gl.glViewport(0, 0, framebuffer.FB_WIDTH, framebuffer.FB_HEIGHT)
+        gl.glClearColor(0.5, 0.6, 0.7, 1.0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+        gl.glUseProgram(framebuffer.render_program)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, framebuffer.render_vertexbuffer)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, ctypes.sizeof(self.data), self.data, gl.GL_DYNAMIC_DRAW)
+        gl.glBindVertexArray(framebuffer.render_vao)
+        for i in range(draws):
+            gl.glDrawArrays(gl.GL_TRIANGLES, 0, len(self.data))
+        gl.glBindVertexArray(0)
+        framebuffer.copy_texture_to_screen()
+
+
+class GlhelperPipeline:
+    '''
+    The calls of glhelper.draw, sending the triangles with render_program.send_data.
+    '''
+    module = glhelper
+    uses_framebuffer = True
+
+    def setup(self, width, height):
+        # the other pipelines bind objects behind the back of the state cache
+        glhelper.current_state().invalidate()
+        glhelper.FB_WIDTH = width
+        glhelper.FB_HEIGHT = height
+        glhelper.framebuffer = glhelper.Framebuffer()
+        glhelper.render_program = glhelper.setup_render_program()
+        glhelper.copy_program = glhelper.setup_copy_program()
+        glhelper.copy_mesh = glhelper.setup_copy_mesh(glhelper.copy_program)
+
+    def teardown(self):
+        for resource in (glhelper.copy_mesh, glhelper.render_program, glhelper.copy_program,
+                         glhelper.framebuffer):
+            resource.release()
+
+    def set_vertices(self, vertices):
+        self.data = glhelper.render_program.pack(vertices)
+        self.count = len(vertices)
+
+    def frame(self, draws):
+        with glhelper.framebuffer:
+            glhelper.current_state().set_clear_color(0.5, 0.6, 0.7, 1.0)
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            glhelper.render_program.send_data(self.data)
+            with glhelper.render_program:
+                for i in range(draws):
+                    gl.glDrawArrays(gl.GL_TRIANGLES, 0, self.count)
+        glhelper.copy_texture_to_screen()
+
+
+PIPELINES = {
+    'vertexbuffer': VertexbufferPipeline,
+    'framebuffer': FramebufferPipeline,
+    'glhelper': GlhelperPipeline,
+}
+
+
+def count_gl_calls(pipeline, draws):
+    '''
+    Return the number of GL calls made by one frame of the pipeline.
+    '''
+    profiler = glprofile.Profiler()
+    modules = [pipeline.module, sys.modules[__name__]]
+    for module in modules:
+        glprofile.enable(module, stages=(), frame=None, profiler=profiler)
+    try:
+        profiler.begin_frame()
+        pipeline.frame(draws)
+        profiler.end_frame()
+    finally:
+        for module in modules:
+            glprofile.disable(module)
+    return profiler.frames[-1]['gl_calls']
+
+
+def measure(pipeline, frames, draws):
+    # warm up, so driver compilation and allocation are not measured
+    pipeline.frame(draws)
+    gl.glFinish()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for i in range(frames):
+        pipeline.frame(draws)
+    gl.glFinish()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    return {
+        'fps': frames / wall,
+        'wall_ms_per_frame': 1000 * wall / frames,
+        'cpu_ms_per_frame': 1000 * cpu / frames,
+        'gl_calls_per_frame': count_gl_calls(pipeline, draws),
+    }
+
+
+def run(pipelines, frames, vertex_counts, draw_counts, sizes):
+    window = pyglet.window.Window(width=640, height=480, visible=False)
+    framebuffer.window = window
+    glhelper.window = window
+
+    info = window.context.get_info()
+    results = {
+        'python': platform.python_version(),
+        'pyglet': pyglet.version,
+        'gl_renderer': info.get_renderer(),
+        'gl_version': info.get_version_string() if hasattr(info, 'get_version_string') else info.get_version(),
+        'frames': frames,
+        'results': [],
+    }
+
+    for name in pipelines:
+        pipeline = PIPELINES[name]()
+        # the framebuffer size only matters for the pipelines rendering into one
+        for width, height in (sizes if pipeline.uses_framebuffer else sizes[:1]):
+            pipeline.setup(width, height)
+            for vertex_count in vertex_counts:
+                pipeline.set_vertices(triangles(vertex_count))
+                for draws in draw_counts:
+                    result = {
+                        'pipeline': name,
+                        'vertices': vertex_count,
+                        'draws': draws,
+                        'framebuffer': [width, height] if pipeline.uses_framebuffer else None,
+                    }
+                    result.update(measure(pipeline, frames, draws))
+                    results['results'].append(result)
+                    sys.stderr.write('{pipeline} {vertices} vertices {draws} draws {framebuffer}: '
+                                     '{fps:.1f} fps, {cpu_ms_per_frame:.3f} ms cpu, '
+                                     '{gl_calls_per_frame} GL calls\n'.format(**result))
+            # free the objects of this size, so they do not pile up over the sweep
+            pipeline.teardown()
+    window.close()
+    return results
+
+
+def int_list(text):
+    return [int(item) for item in text.split(',')]
+
+def size_list(text):
+    return [tuple(int(n) for n in item.split('x')) for item in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pipelines', type=lambda text: text.split(','), default=list(PIPELINES),
+                        help='comma separated subset of %s' % ','.join(PIPELINES))
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--vertices', type=int_list, default=[3, 3000, 30000],
+                        help='comma separated vertex counts')
+    parser.add_argument('--draws', type=int_list, default=[1, 10, 100],
+                        help='comma separated draw calls per frame')
+    parser.add_argument('--sizes', type=size_list, default=[(30, 20), (256, 256), (1024, 1024)],
+                        help='comma separated framebuffer sizes, e.g. 30x20,1024x1024')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = run(args.pipelines, args.frames, args.vertices, args.draws, args.sizes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
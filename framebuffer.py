@@ -8,12 +8,14 @@ Example code for using glsl and vertex buffer objects with pyglet
 import pyglet
 from pyglet import gl
 import ctypes
+from scheduler import FrameScheduler
 
 render_vertexbuffer = gl.GLuint(0)
 render_vao = gl.GLuint(0)
 render_program = 0
 
 copy_vertexbuffer = gl.GLuint(0)
+copy_indexbuffer = gl.GLuint(0)
 copy_vao = gl.GLuint(0)
 copy_program = 0
 
@@ -176,7 +178,7 @@ def setup_copy_vertexbuffer():
     '''
     Create the vertexbuffer object for the copying program
     '''
-    # gl.glGenVertexArrays(1, ctypes.byref(copy_vao))
+    gl.glGenVertexArrays(1, ctypes.byref(copy_vao))
     gl.glGenBuffers(1, ctypes.byref(copy_vertexbuffer))
 
     loc_position = gl.glGetAttribLocation(copy_program, ctypes.create_string_buffer(b'position'))
@@ -197,6 +199,13 @@ def setup_copy_vertexbuffer():
     gl.glVertexAttribPointer(loc_position, 2, gl.GL_FLOAT, False, ctypes.sizeof(TEXTURE_VERTEX), ctypes.c_void_p(TEXTURE_VERTEX.position.offset))
     gl.glVertexAttribPointer(loc_texcoord, 2, gl.GL_FLOAT, False, ctypes.sizeof(TEXTURE_VERTEX), ctypes.c_void_p(TEXTURE_VERTEX.texcoord.offset))
 
+    # the two quads are drawn as four triangles sharing vertices
+    gl.glGenBuffers(1, ctypes.byref(copy_indexbuffer))
+    indices = (gl.GLushort * 12)(0, 1, 2, 0, 2, 3,
+                                 4, 5, 6, 4, 6, 7)
+    gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, copy_indexbuffer)
+    gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, ctypes.sizeof(indices), indices, gl.GL_STATIC_DRAW)
+
     gl.glBindVertexArray(0)
 
 
@@ -263,7 +272,7 @@ def copy_texture_to_screen():
 
     # draw
     gl.glBindVertexArray(copy_vao)
-    gl.glDrawArrays(gl.GL_QUADS, 0, 8)
+    gl.glDrawElements(gl.GL_TRIANGLES, 12, gl.GL_UNSIGNED_SHORT, None)
     gl.glBindVertexArray(0)
 
 
@@ -298,8 +307,7 @@ def main():
 
     print('OpenGL Version {}'.format(window.context.get_info().get_version()))
     window.on_draw = draw
-    pyglet.clock.schedule_interval(lambda dt:None, 0.01)
-    pyglet.app.run()
+    FrameScheduler(window).run()
 
 
 if __name__ == '__main__':
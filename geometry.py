@@ -0,0 +1,181 @@
+'''
+Author: leovt (Leonhard Vogt)
+License: GNU GENERAL PUBLIC LICENSE - Version 3, 29 June 2007
+
+Vectorized vertex data for quads, sprites and thick lines
+
+Every builder takes the ShaderProgram the data is for and returns a
+numpy array in its VERTEX layout (see glhelper.vertex_dtype), ready for
+send_data or Mesh. The vertices are computed with whole-array numpy
+operations, there are no Python loops over quads.
+
+    vertices = sprites(copy_program, x, y, 16, 16, uv_rects=uv)
+    mesh = Mesh(copy_program, vertices, indices=quad_index_array(len(x)))
+
+Quads are four vertices each, counterclockwise from the lower left
+corner, to be drawn with the indices of quad_index_array. Positions go
+into the 'position' attribute, colors into 'color' and texture
+coordinates into 'texcoord'; attributes the program does not have are
+skipped. Colors are floats in [0, 1] and are quantized as needed, e.g.
+for normalized byte attributes.
+'''
+
+import numpy
+from pyglet import gl
+
+import glhelper
+
+
+def quad_index_array(quad_count):
+    '''
+    Return the indices drawing quad_count quads as two triangles each,
+    the numpy equivalent of glhelper.quad_indices.
+    '''
+    dtype = numpy.uint16 if 4 * quad_count <= 0x10000 else numpy.uint32
+    return (4 * numpy.arange(quad_count, dtype=dtype)[:, None] +
+            numpy.array((0, 1, 2, 0, 2, 3), dtype)).ravel()
+
+
+def _build_dtype(struct):
+    '''
+    Return the dtype to compute vertices in: the VERTEX layout itself if
+    it only has float attributes, else the same fields as floats, which
+    pack() quantizes.
+    '''
+    if all(tname in (gl.GL_FLOAT, gl.GL_DOUBLE) for (name, tname, size, normalized) in struct.attributes):
+        return glhelper.struct_dtype(struct)
+    return numpy.dtype([(name, 'f8' if tname == gl.GL_DOUBLE else 'f4', (size,))
+                        for (name, tname, size, normalized) in struct.attributes])
+
+
+def _assign(vertices, name, values):
+    if name not in vertices.dtype.names:
+        return
+    field = vertices[name]
+    components = min(field.shape[-1], values.shape[-1])
+    field[:, :components] = values[:, :components]
+
+
+def _per_vertex(values, count, corners=4):
+    '''
+    Broadcast one value, one value per quad or one value per vertex,
+    as (n * corners, c) or (n, corners, c) array, to an array with one
+    row per vertex.
+    '''
+    values = numpy.asarray(values, numpy.float32)
+    if values.ndim == 1:
+        return numpy.broadcast_to(values, (count * corners, values.shape[0]))
+    if values.ndim == 2 and len(values) != count * corners:
+        return numpy.repeat(values, corners, axis=0)
+    return values.reshape(count * corners, values.shape[-1])
+
+
+def _vertices(program, corners, colors=None, texcoords=None):
+    '''
+    Return the vertices of quads given by their (n, 4, 2) corners.
+    '''
+    count = corners.shape[0]
+    vertices = numpy.zeros(4 * count, _build_dtype(program.VERTEX))
+    _assign(vertices, 'position', corners.reshape(-1, 2))
+    if colors is not None:
+        _assign(vertices, 'color', _per_vertex(colors, count))
+    if texcoords is not None:
+        _assign(vertices, 'texcoord', texcoords.reshape(-1, 2))
+    return program.pack(vertices)
+
+
+def _rect_corners(x0, y0, x1, y1):
+    return numpy.stack([numpy.stack([x0, y0], -1), numpy.stack([x1, y0], -1),
+                        numpy.stack([x1, y1], -1), numpy.stack([x0, y1], -1)], 1)
+
+
+def _arrays(*values):
+    return numpy.broadcast_arrays(*(numpy.atleast_1d(numpy.asarray(value, numpy.float32))
+                                    for value in values))
+
+
+def _uv_corners(uv_rects, count):
+    uv = numpy.broadcast_to(numpy.asarray(uv_rects, numpy.float32), (count, 4))
+    return _rect_corners(uv[:, 0], uv[:, 1], uv[:, 2], uv[:, 3])
+
+
+def quads(program, x, y, width, height, colors=None, uv_rects=None):
+    '''
+    Return axis aligned quads with lower left corner (x, y).
+
+    All arguments may be scalars or arrays of one value per quad.
+    colors are one color, one per quad, or one per vertex as (4 * n, c)
+    or (n, 4, c) array. uv_rects are (u0, v0, u1, v1) rectangles, one
+    for all or one per quad.
+    '''
+    x, y, width, height = _arrays(x, y, width, height)
+    corners = _rect_corners(x, y, x + width, y + height)
+    texcoords = None if uv_rects is None else _uv_corners(uv_rects, len(x))
+    return _vertices(program, corners, colors, texcoords)
+
+
+def rotated_quads(program, x, y, width, height, angle, colors=None, uv_rects=None):
+    '''
+    Return quads centered on (x, y), rotated counterclockwise by angle
+    (in radians).
+    '''
+    x, y, width, height, angle = _arrays(x, y, width, height, angle)
+    local = _rect_corners(-width / 2, -height / 2, width / 2, height / 2)
+    cos = numpy.cos(angle)[:, None]
+    sin = numpy.sin(angle)[:, None]
+    corners = numpy.empty_like(local)
+    corners[..., 0] = x[:, None] + cos * local[..., 0] - sin * local[..., 1]
+    corners[..., 1] = y[:, None] + sin * local[..., 0] + cos * local[..., 1]
+    texcoords = None if uv_rects is None else _uv_corners(uv_rects, len(x))
+    return _vertices(program, corners, colors, texcoords)
+
+
+def sprites(program, x, y, width, height, uv_rects=(0.0, 0.0, 1.0, 1.0), angle=None, colors=None):
+    '''
+    Return textured quads centered on (x, y), e.g. with the uv rectangles
+    of atlas regions, optionally rotated by angle.
+    '''
+    if angle is None:
+        x, y, width, height = _arrays(x, y, width, height)
+        return quads(program, x - width / 2, y - height / 2, width, height, colors, uv_rects)
+    return rotated_quads(program, x, y, width, height, angle, colors, uv_rects)
+
+
+def polyline(program, points, width, colors=None, closed=False, miter_limit=4.0):
+    '''
+    Return a line of the given width through points as one quad per
+    segment.
+
+    Neighbouring segments share the corners of a miter join, which is
+    limited to miter_limit times the half width at sharp angles.
+    colors may be one color or one color per point.
+    '''
+    points = numpy.asarray(points, numpy.float32)
+    if closed:
+        points = numpy.concatenate([points, points[:1]])
+    direction = numpy.diff(points, axis=0)
+    direction /= numpy.maximum(numpy.hypot(direction[:, 0], direction[:, 1]), 1e-12)[:, None]
+    normal = numpy.stack([-direction[:, 1], direction[:, 0]], -1)
+
+    # at each point the average of the normals of the adjacent segments
+    if closed:
+        before = numpy.roll(normal, 1, axis=0)
+        before = numpy.concatenate([before, before[:1]])
+        after = numpy.concatenate([normal, normal[:1]])
+    else:
+        before = numpy.concatenate([normal[:1], normal])
+        after = numpy.concatenate([normal, normal[-1:]])
+    miter = before + after
+    miter /= numpy.maximum(numpy.hypot(miter[:, 0], miter[:, 1]), 1e-12)[:, None]
+    scale = 1.0 / numpy.maximum((miter * after).sum(-1), 1.0 / miter_limit)
+    offset = miter * (scale * width / 2)[:, None]
+
+    corners = numpy.stack([points[:-1] - offset[:-1], points[1:] - offset[1:],
+                           points[1:] + offset[1:], points[:-1] + offset[:-1]], 1)
+    if colors is not None:
+        colors = numpy.asarray(colors, numpy.float32)
+        if colors.ndim == 2:
+            if closed:
+                colors = numpy.concatenate([colors, colors[:1]])
+            colors = numpy.stack([colors[:-1], colors[1:], colors[1:], colors[:-1]], 1)
+    return _vertices(program, corners, colors)
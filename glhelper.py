@@ -5,14 +5,42 @@ License: GNU GENERAL PUBLIC LICENSE - Version 3, 29 June 2007
 Example code for using glsl and vertex buffer objects with pyglet
 '''
 
+import os
+import re
 import sys
+import math
+import time
+import struct
+import hashlib
+import contextlib
+import collections
 import warnings
+import weakref
+import threading
+# the import time of pyglet can only be measured if glhelper imports it first,
+# scripts importing pyglet before glhelper (benchmark.py, renderfarm.py) get no number
+_pyglet_imported = 'pyglet' in sys.modules
+_import_start = time.perf_counter()
 import pyglet
 from pyglet import gl
+from pyglet.gl import gl_info
+_import_end = time.perf_counter()
 import ctypes
 
+from scheduler import FrameScheduler
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 render_program = None
 copy_program = None
+render_mesh = None
+copy_mesh = None
+render_timer = None
+copy_timer = None
+render_targets = None
 framebuffer = None
 window = None
 
@@ -28,11 +56,552 @@ TYPE_NAME_TO_TYPE = {
     gl.GL_UNSIGNED_BYTE: gl.GLubyte,
     gl.GL_SHORT: gl.GLshort,
     gl.GL_UNSIGNED_SHORT: gl.GLushort,
+    # stored as raw bits, see quantize
+    gl.GL_HALF_FLOAT: gl.GLushort,
+    gl.GL_INT_2_10_10_10_REV: gl.GLuint,
+    gl.GL_UNSIGNED_INT_2_10_10_10_REV: gl.GLuint,
 }
 
-def compile_shader(shader_type, shader_source):
+# four components packed into a single 32 bit integer
+PACKED_TYPES = (gl.GL_INT_2_10_10_10_REV, gl.GL_UNSIGNED_INT_2_10_10_10_REV)
+
+# largest value of the integer types, which normalized float 1.0 maps to
+INTEGER_MAX = {
+    gl.GL_INT: 0x7FFFFFFF,
+    gl.GL_UNSIGNED_INT: 0xFFFFFFFF,
+    gl.GL_BYTE: 0x7F,
+    gl.GL_UNSIGNED_BYTE: 0xFF,
+    gl.GL_SHORT: 0x7FFF,
+    gl.GL_UNSIGNED_SHORT: 0xFFFF,
+}
+
+TYPE_NAME_TO_DTYPE = {
+    gl.GL_FLOAT: 'f4',
+    gl.GL_DOUBLE: 'f8',
+    gl.GL_INT: 'i4',
+    gl.GL_UNSIGNED_INT: 'u4',
+    gl.GL_BYTE: 'i1',
+    gl.GL_UNSIGNED_BYTE: 'u1',
+    gl.GL_SHORT: 'i2',
+    gl.GL_UNSIGNED_SHORT: 'u2',
+    gl.GL_HALF_FLOAT: 'f2',
+    gl.GL_INT_2_10_10_10_REV: 'u4',
+    gl.GL_UNSIGNED_INT_2_10_10_10_REV: 'u4',
+}
+
+def _value(name):
+    return getattr(name, 'value', name)
+
+
+class GLState:
     '''
-    Compile a shader and print error messages.
+    Cache of the binding state of a GL context.
+
+    Every method only calls into GL when the value actually changes.
+    All binds in this module go through the state of the current context,
+    call invalidate() when other code (e.g. pyglet itself) may have changed
+    the GL state behind its back.
+
+    With unbind_on_exit set to False the context managers leave their
+    objects bound on exit instead of resetting the bindings to 0.
+    '''
+    def __init__(self):
+        self.unbind_on_exit = True
+        self.invalidate()
+
+    def invalidate(self):
+        self.program = None
+        self.vertex_array = None
+        self.buffers = {}
+        self.active_texture = None
+        self.textures = {}
+        self.buffer_bases = {}
+        self.framebuffer = None
+        self.viewport = None
+        self.clear_color = None
+
+
+    def use_program(self, name):
+        name = _value(name)
+        if name != self.program:
+            gl.glUseProgram(name)
+            self.program = name
+
+    def bind_vertex_array(self, name):
+        name = _value(name)
+        if name != self.vertex_array:
+            gl.glBindVertexArray(name)
+            self.vertex_array = name
+            # the element array binding is part of the vertex array state
+            self.buffers.pop(gl.GL_ELEMENT_ARRAY_BUFFER, None)
+
+    def bind_buffer(self, target, name):
+        name = _value(name)
+        if name != self.buffers.get(target):
+            gl.glBindBuffer(target, name)
+            self.buffers[target] = name
+
+    def bind_buffer_base(self, target, index, name):
+        name = _value(name)
+        if name != self.buffer_bases.get((target, index)):
+            gl.glBindBufferBase(target, index, name)
+            self.buffer_bases[target, index] = name
+            # also binds the buffer to the generic target
+            self.buffers[target] = name
+
+    def bind_texture(self, target, name, unit=0):
+        name = _value(name)
+        if name != self.textures.get((unit, target)):
+            if unit != self.active_texture:
+                gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+                self.active_texture = unit
+            gl.glBindTexture(target, name)
+            self.textures[unit, target] = name
+
+    def bind_framebuffer(self, name):
+        name = _value(name)
+        if name != self.framebuffer:
+            gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, name)
+            self.framebuffer = name
+
+    def set_viewport(self, x, y, width, height):
+        if (x, y, width, height) != self.viewport:
+            gl.glViewport(x, y, width, height)
+            self.viewport = (x, y, width, height)
+
+    def set_clear_color(self, red, green, blue, alpha):
+        if (red, green, blue, alpha) != self.clear_color:
+            gl.glClearColor(red, green, blue, alpha)
+            self.clear_color = (red, green, blue, alpha)
+
+
+    # deleting a bound object reverts its binding to 0
+    def forget_program(self, name):
+        if _value(name) == self.program:
+            self.program = 0
+
+    def forget_vertex_array(self, name):
+        if _value(name) == self.vertex_array:
+            self.vertex_array = 0
+
+    def forget_buffer(self, name):
+        name = _value(name)
+        for target, bound in list(self.buffers.items()):
+            if bound == name:
+                self.buffers[target] = 0
+        for key, bound in list(self.buffer_bases.items()):
+            if bound == name:
+                self.buffer_bases[key] = 0
+
+    def forget_texture(self, name):
+        name = _value(name)
+        for key, bound in list(self.textures.items()):
+            if bound == name:
+                self.textures[key] = 0
+
+    def forget_framebuffer(self, name):
+        if _value(name) == self.framebuffer:
+            self.framebuffer = 0
+
+
+class StartupReport:
+    '''
+    Wall time spent in the phases of starting up, until the first frame.
+
+    Phases may be nested, the time of the inner phase is not counted
+    for the outer one. Nothing is recorded after the first frame.
+    '''
+    def __init__(self, origin=None):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.phases = collections.OrderedDict()
+        self.stack = []
+        self.mark = None
+        self.first_frame = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.first_frame is not None:
+            yield
+            return
+        now = time.perf_counter()
+        if self.stack:
+            self._charge(now)
+        self.stack.append(name)
+        self.mark = now
+        try:
+            yield
+        finally:
+            self._charge(time.perf_counter())
+            self.stack.pop()
+
+    def _charge(self, now):
+        name = self.stack[-1]
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+    def frame_done(self):
+        if self.first_frame is None:
+            self.first_frame = time.perf_counter() - self.origin
+
+    def __str__(self):
+        phases = ''.join(', %s %.1f ms' % (name, 1000 * seconds) for name, seconds in self.phases.items())
+        if self.first_frame is None:
+            return 'startup: no frame yet' + phases
+        return 'startup: first frame after %.1f ms%s' % (1000 * self.first_frame, phases)
+
+
+startup = StartupReport(_import_start)
+if not _pyglet_imported:
+    startup.phases['import pyglet'] = _import_end - _import_start
+
+
+class Lazy:
+    '''
+    Stand-in for a resource which is created by calling factory(*args)
+    on first use, e.g. when an attribute is accessed or a with block is
+    entered. get() returns the resource itself.
+    '''
+    def __init__(self, factory, *args, phase='allocate resources'):
+        self._factory = factory
+        self._args = args
+        self._phase = phase
+        self._object = None
+
+    def get(self):
+        if self._object is None:
+            with startup.phase(self._phase):
+                self._object = self._factory(*self._args)
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __enter__(self):
+        return self.get().__enter__()
+
+    def __exit__(self, *args):
+        return self.get().__exit__(*args)
+
+    @property
+    def created(self):
+        return self._object is not None
+
+    def release(self):
+        if self._object is not None:
+            self._object.release()
+
+    def __str__(self):
+        if self._object is None:
+            return 'not created'
+        return str(self._object)
+
+
+_states = weakref.WeakKeyDictionary()
+
+# pyglet.gl.current_context is a process wide global, threads which make
+# another context current register it here (see loader.py)
+_thread_contexts = threading.local()
+
+def set_thread_context(context):
+    '''
+    Declare context as the one current on the calling thread.
+    '''
+    _thread_contexts.context = context
+
+def current_state():
+    '''
+    Return the GLState of the current context.
+    '''
+    context = getattr(_thread_contexts, 'context', None) or gl.current_context
+    state = _states.get(context)
+    if state is None:
+        state = _states[context] = GLState()
+    return state
+
+
+class ResourceRegistry:
+    '''
+    The live GL resources and an estimate of the memory they use.
+
+    Resources add themselves when they are created and remove themselves
+    in release(), so whatever is left at shutdown has leaked. budget (in
+    bytes) is only used by gauge().
+    '''
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.live = {}
+        self._keys = iter(range(1, sys.maxsize))
+
+    def add(self, resource, size=0):
+        resource._registry_key = key = next(self._keys)
+        self.live[key] = [type(resource).__name__, size, _creation_site()]
+
+    def resize(self, resource, size):
+        entry = self.live.get(getattr(resource, '_registry_key', None))
+        if entry:
+            entry[1] = size
+
+    def remove(self, resource):
+        self.live.pop(getattr(resource, '_registry_key', None), None)
+
+
+    def totals(self):
+        '''
+        Return {type name: (count, bytes)} of the live resources.
+        '''
+        totals = {}
+        for kind, size, site in self.live.values():
+            count, total = totals.get(kind, (0, 0))
+            totals[kind] = (count + 1, total + size)
+        return totals
+
+    def gauge(self):
+        '''
+        Return the estimated bytes in use and the fraction of the budget.
+        '''
+        used = sum(entry[1] for entry in self.live.values())
+        return {'bytes': used, 'budget': self.budget,
+                'fraction': used / self.budget if self.budget else None}
+
+    def report(self):
+        '''
+        Return the live resources per type with the place each was created.
+        '''
+        if not self.live:
+            return 'GL resources: none live'
+        lines = ['GL resources: %d live, %d bytes' % (len(self.live), self.gauge()['bytes'])]
+        for kind, (count, total) in sorted(self.totals().items()):
+            lines.append('  %s: %d live, %d bytes' % (kind, count, total))
+            for entry_kind, size, site in self.live.values():
+                if entry_kind == kind:
+                    lines.append('    %d bytes, created at %s:%d in %s' % ((size,) + site))
+        return '\n'.join(lines)
+
+
+_pyglet_directory = os.path.dirname(pyglet.__file__)
+_glhelper_file = os.path.abspath(__file__)
+_glprofile_file = os.path.join(os.path.dirname(_glhelper_file), 'glprofile.py')
+
+# module level functions of the library part of this file, the others are example code
+_library_functions = {'static_buffer', 'submit_shader', 'check_shader', 'compile_shader', 'link_program',
+                      'check_program', 'wait_sync', 'allocate_texture_storage', 'compile_programs',
+                      'enable_parallel_compile', 'enable_debug_output', 'current_state', 'owned'}
+
+
+def _library_frame(frame):
+    '''
+    Return True for frames of pyglet, glprofile or the methods and helpers
+    of this module, which are skipped when reporting where something
+    happened in the calling code.
+    '''
+    filename = os.path.abspath(frame.f_code.co_filename)
+    if filename.startswith(_pyglet_directory) or filename == _glprofile_file:
+        return True
+    name = frame.f_code.co_name
+    return filename == _glhelper_file and (
+        'self' in frame.f_locals or name in _library_functions or name.startswith('_'))
+
+
+def _creation_site():
+    '''
+    Return (filename, line, function) of the code creating a resource,
+    skipping the methods and helpers of this module involved.
+    '''
+    frame = sys._getframe(2)
+    while frame.f_back and _library_frame(frame):
+        frame = frame.f_back
+    return (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+def _stacklevel():
+    '''
+    Return the stacklevel making warnings.warn, called by the caller of
+    this function, name the first line outside the library.
+    '''
+    level = 1
+    frame = sys._getframe(1)
+    while frame.f_back and _library_frame(frame):
+        frame = frame.f_back
+        level += 1
+    return level
+
+
+registry = ResourceRegistry()
+
+
+@contextlib.contextmanager
+def owned(*resources):
+    '''
+    Release the resources when the with block is left.
+
+        with owned(Mesh(program, vertices)) as mesh:
+            mesh.draw()
+
+    (entering a resource itself with `with` binds it instead).
+    '''
+    try:
+        yield resources[0] if len(resources) == 1 else resources
+    finally:
+        for resource in reversed(resources):
+            resource.release()
+
+
+# bytes per pixel of the internal formats, for the memory estimates
+INTERNAL_FORMAT_BYTES = {
+    gl.GL_R8: 1,
+    gl.GL_RG8: 2,
+    gl.GL_RGB8: 4,
+    gl.GL_RGBA8: 4,
+    gl.GL_SRGB8_ALPHA8: 4,
+    gl.GL_RGBA16F: 8,
+    gl.GL_RGBA32F: 16,
+    gl.GL_R32F: 4,
+    gl.GL_DEPTH24_STENCIL8: 4,
+}
+
+
+# GL_KHR_parallel_shader_compile
+GL_MAX_SHADER_COMPILER_THREADS_KHR = 0x91B0
+GL_COMPLETION_STATUS_KHR = 0x91B1
+
+_parallel_compile = False
+
+def enable_parallel_compile(threads=0xFFFFFFFF):
+    '''
+    Let the driver compile shaders on multiple threads if it supports
+    GL_KHR_parallel_shader_compile. Return True if it does.
+
+    The default number of threads leaves the choice to the driver.
+    '''
+    global _parallel_compile
+    for extension, suffix in (('GL_KHR_parallel_shader_compile', 'KHR'),
+                              ('GL_ARB_parallel_shader_compile', 'ARB')):
+        if gl_info.have_extension(extension):
+            from pyglet.gl.lib import link_GL
+            max_threads = link_GL('glMaxShaderCompilerThreads' + suffix, None, [gl.GLuint])
+            max_threads(threads)
+            _parallel_compile = True
+            break
+    return _parallel_compile
+
+
+DEBUG_SOURCES = {
+    gl.GL_DEBUG_SOURCE_API: 'api',
+    gl.GL_DEBUG_SOURCE_WINDOW_SYSTEM: 'window system',
+    gl.GL_DEBUG_SOURCE_SHADER_COMPILER: 'shader compiler',
+    gl.GL_DEBUG_SOURCE_THIRD_PARTY: 'third party',
+    gl.GL_DEBUG_SOURCE_APPLICATION: 'application',
+    gl.GL_DEBUG_SOURCE_OTHER: 'other',
+}
+
+DEBUG_TYPES = {
+    gl.GL_DEBUG_TYPE_ERROR: 'error',
+    gl.GL_DEBUG_TYPE_DEPRECATED_BEHAVIOR: 'deprecated',
+    gl.GL_DEBUG_TYPE_UNDEFINED_BEHAVIOR: 'undefined behavior',
+    gl.GL_DEBUG_TYPE_PORTABILITY: 'portability',
+    gl.GL_DEBUG_TYPE_PERFORMANCE: 'performance',
+    gl.GL_DEBUG_TYPE_MARKER: 'marker',
+    gl.GL_DEBUG_TYPE_PUSH_GROUP: 'push group',
+    gl.GL_DEBUG_TYPE_POP_GROUP: 'pop group',
+    gl.GL_DEBUG_TYPE_OTHER: 'other',
+}
+
+DEBUG_SEVERITIES = {
+    gl.GL_DEBUG_SEVERITY_HIGH: 'high',
+    gl.GL_DEBUG_SEVERITY_MEDIUM: 'medium',
+    gl.GL_DEBUG_SEVERITY_LOW: 'low',
+    gl.GL_DEBUG_SEVERITY_NOTIFICATION: 'notification',
+}
+
+# messages of these types are logged with the Python code which caused them
+LOGGED_DEBUG_TYPES = (gl.GL_DEBUG_TYPE_ERROR, gl.GL_DEBUG_TYPE_UNDEFINED_BEHAVIOR, gl.GL_DEBUG_TYPE_PERFORMANCE)
+
+class DebugOutput:
+    '''
+    Receives the messages of the GL debug output (GL 4.3 or KHR_debug).
+
+    Messages are counted by (source, type, severity). Errors and
+    performance warnings are written to log together with the Python
+    call site, once per call site and message. With synchronous output
+    the callback runs inside the offending GL call, otherwise the
+    call site is only approximate.
+
+    Drivers may only report much on a debug context, e.g. a window
+    created with gl.Config(debug=True).
+    '''
+    def __init__(self, synchronous=True, log=sys.stderr):
+        self.log = log
+        self.counts = collections.Counter()
+        self.sites = collections.Counter()
+        # keep a reference, the callback must outlive its registration
+        self._callback = gl.GLDEBUGPROC(self._message)
+        gl.glEnable(gl.GL_DEBUG_OUTPUT)
+        if synchronous:
+            gl.glEnable(gl.GL_DEBUG_OUTPUT_SYNCHRONOUS)
+        gl.glDebugMessageCallback(self._callback, None)
+
+    def _message(self, source, message_type, message_id, severity, length, message, user_param):
+        text = ctypes.string_at(message, length).decode('utf-8', 'replace').strip()
+        self.counts[DEBUG_SOURCES.get(source, source),
+                    DEBUG_TYPES.get(message_type, message_type),
+                    DEBUG_SEVERITIES.get(severity, severity)] += 1
+        if message_type not in LOGGED_DEBUG_TYPES:
+            return
+        site = self._call_site()
+        self.sites[site, text] += 1
+        if self.sites[site, text] == 1:
+            self.log.write('GL %s: %s\n  at %s:%d in %s\n' % ((DEBUG_TYPES[message_type], text) + site))
+
+    @staticmethod
+    def _call_site():
+        '''
+        Return (filename, line, function) of the innermost stack frame
+        outside of the library, see _library_frame.
+        '''
+        frame = sys._getframe(1)
+        while frame.f_back and _library_frame(frame):
+            frame = frame.f_back
+        return (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+    def summary(self):
+        '''
+        Return one line per (source, type, severity) bucket, most frequent first.
+        '''
+        if not self.counts:
+            return 'no GL debug messages'
+        return '\n'.join('%6d %s / %s / %s' % ((count,) + key) for key, count in self.counts.most_common())
+
+    def release(self):
+        global _debug_output
+        gl.glDebugMessageCallback(gl.GLDEBUGPROC(), None)
+        gl.glDisable(gl.GL_DEBUG_OUTPUT)
+        if _debug_output is self:
+            _debug_output = None
+
+
+_debug_output = None
+
+def enable_debug_output(synchronous=True, log=sys.stderr):
+    '''
+    Install a DebugOutput on the current context and return it, or None
+    if the driver does not support it.
+
+    While it is installed check_shader and check_program also report
+    warnings of successful compiles; otherwise (release mode) they only
+    fetch the info log when compiling or linking fails.
+    '''
+    global _debug_output
+    if not (gl_info.have_version(4, 3) or gl_info.have_extension('GL_KHR_debug')):
+        warnings.warn('GL debug output is not supported.', stacklevel=2)
+        return None
+    _debug_output = DebugOutput(synchronous, log)
+    return _debug_output
+
+
+def submit_shader(shader_type, shader_source):
+    '''
+    Start compiling a shader without waiting for the result.
     '''
     shader_name = gl.glCreateShader(shader_type)
     src_buffer = ctypes.create_string_buffer(shader_source)
@@ -40,10 +609,18 @@ def compile_shader(shader_type, shader_source):
     length = ctypes.c_int(len(shader_source) + 1)
     gl.glShaderSource(shader_name, 1, buf_pointer, ctypes.byref(length))
     gl.glCompileShader(shader_name)
+    return shader_name
 
-    # test if compilation is succesful and print status messages
+
+def check_shader(shader_name):
+    '''
+    Wait for a submitted shader to compile and print error messages.
+    '''
     success = gl.GLint(0)
     gl.glGetShaderiv(shader_name, gl.GL_COMPILE_STATUS, ctypes.byref(success))
+    # warnings are only of interest while debugging
+    if success and _debug_output is None:
+        return
 
     length = gl.GLint(0)
     gl.glGetShaderiv(shader_name, gl.GL_INFO_LOG_LENGTH, ctypes.byref(length))
@@ -57,6 +634,13 @@ def compile_shader(shader_type, shader_source):
     if not success:
         raise ValueError('Compiling of the shader failed.')
 
+
+def compile_shader(shader_type, shader_source):
+    '''
+    Compile a shader and print error messages.
+    '''
+    shader_name = submit_shader(shader_type, shader_source)
+    check_shader(shader_name)
     return shader_name
 
 
@@ -65,9 +649,17 @@ def link_program(program_name):
     link a glsl program and print error messages.
     '''
     gl.glLinkProgram(program_name)
+    check_program(program_name)
+
 
+def check_program(program_name):
+    '''
+    Wait for a program to link and print error messages.
+    '''
     success = gl.GLint(0)
     gl.glGetProgramiv(program_name, gl.GL_LINK_STATUS, ctypes.byref(success))
+    if success and _debug_output is None:
+        return
 
     length = gl.GLint(0)
     gl.glGetProgramiv(program_name, gl.GL_INFO_LOG_LENGTH, ctypes.byref(length))
@@ -82,61 +674,1515 @@ def link_program(program_name):
         raise ValueError('Linking of the shader program failed.')
 
 
+def wait_sync(sync):
+    '''
+    Block until the GPU has passed the fence sync, then delete it.
+    '''
+    while True:
+        result = gl.glClientWaitSync(sync, gl.GL_SYNC_FLUSH_COMMANDS_BIT, 1000000)
+        if result != gl.GL_TIMEOUT_EXPIRED:
+            break
+    gl.glDeleteSync(sync)
+
+
+class StreamBuffer:
+    '''
+    A buffer object of fixed size split into regions which are written
+    round robin, one region per frame.
+
+    Data is written through glMapBufferRange with the unsynchronized flag.
+    A fence sync placed at the end of each frame makes sure a region is not
+    overwritten while the GPU may still read from it. Without sync objects
+    the buffer is orphaned instead whenever the writes wrap around.
+    '''
+    def __init__(self, region_size, regions=3, target=gl.GL_ARRAY_BUFFER):
+        self.target = target
+        self.region_size = region_size
+        self.regions = regions
+        self.region = 0
+        self.offset = 0
+        self.fences = [None] * regions
+        self.use_sync = gl_info.have_version(3, 2) or gl_info.have_extension('GL_ARB_sync')
+        self.use_map = gl_info.have_version(3, 0) or gl_info.have_extension('GL_ARB_map_buffer_range')
+
+        self.name = gl.GLuint(0)
+        gl.glGenBuffers(1, ctypes.byref(self.name))
+        self._allocate()
+        registry.add(self, region_size * regions)
+
+    def _allocate(self):
+        state = current_state()
+        state.bind_buffer(self.target, self.name)
+        gl.glBufferData(self.target, self.region_size * self.regions, None, gl.GL_STREAM_DRAW)
+        self._unbind(state)
+
+    def _unbind(self, state):
+        # a bound pixel buffer turns the pointers of other uploads into offsets, never leave it bound
+        if state.unbind_on_exit or self.target != gl.GL_ARRAY_BUFFER:
+            state.bind_buffer(self.target, 0)
+
+
+    def fits(self, size, alignment=1):
+        '''
+        Return True if size more bytes fit into the current region.
+        '''
+        return _align(self.offset, alignment) + size <= self.region_size
+
+    def write(self, data, alignment=1):
+        '''
+        Copy data into the current region and return its byte offset
+        within the buffer.
+        '''
+        pointer, size = buffer_pointer(data)
+        start = _align(self.offset, alignment)
+        if start + size > self.region_size:
+            raise ValueError('%d bytes do not fit into the stream buffer region.' % size)
+        offset = self.region * self.region_size + start
+        self.offset = start + size
+        if not size:
+            return offset
+
+        state = current_state()
+        state.bind_buffer(self.target, self.name)
+        if self.use_map:
+            access = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_INVALIDATE_RANGE_BIT | gl.GL_MAP_UNSYNCHRONIZED_BIT
+            mapped = gl.glMapBufferRange(self.target, offset, size, access)
+            ctypes.memmove(mapped, pointer, size)
+            gl.glUnmapBuffer(self.target)
+        else:
+            gl.glBufferSubData(self.target, offset, size, pointer)
+        self._unbind(state)
+        return offset
+
+
+    def end_frame(self):
+        '''
+        Fence the region written in this frame and move on to the next one,
+        waiting for the GPU to release it if necessary.
+        '''
+        if self.use_sync:
+            self.fences[self.region] = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.region = (self.region + 1) % self.regions
+        self.offset = 0
+
+        if self.use_sync:
+            if self.fences[self.region]:
+                wait_sync(self.fences[self.region])
+                self.fences[self.region] = None
+        elif self.region == 0:
+            # orphan the storage, the driver keeps the old one alive until the GPU is done
+            self._allocate()
+
+
+    def release(self):
+        for fence in self.fences:
+            if fence:
+                gl.glDeleteSync(fence)
+        self.fences = [None] * self.regions
+        current_state().forget_buffer(self.name)
+        gl.glDeleteBuffers(1, ctypes.byref(self.name))
+        registry.remove(self)
+
+
+class ProgramCache:
+    '''
+    On-disk cache of linked program binaries.
+
+    Binaries are keyed by a hash of the shader sources and the GL vendor,
+    renderer and version strings, so a driver update invalidates them.
+    When the driver rejects a binary the program is compiled from source
+    and the cache entry is replaced.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._supported = None
+
+    def supported(self):
+        if self._supported is None:
+            formats = gl.GLint(0)
+            if gl_info.have_version(4, 1) or gl_info.have_extension('GL_ARB_get_program_binary'):
+                gl.glGetIntegerv(gl.GL_NUM_PROGRAM_BINARY_FORMATS, ctypes.byref(formats))
+            self._supported = formats.value > 0
+        return self._supported
+
+
+    def key(self, *sources):
+        digest = hashlib.sha256()
+        for name in (gl.GL_VENDOR, gl.GL_RENDERER, gl.GL_VERSION):
+            digest.update(ctypes.cast(gl.glGetString(name), ctypes.c_char_p).value + b'\0')
+        for source in sources:
+            digest.update(source + b'\0')
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.bin')
+
+
+    def load(self, program_name, key):
+        '''
+        Load the cached binary for key into the program.
+        Return True if the program is linked successfully.
+        '''
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return False
+
+        success = gl.GLint(0)
+        if len(data) > 4 and self.supported():
+            binary_format, = struct.unpack('<I', data[:4])
+            try:
+                gl.glProgramBinary(program_name, binary_format, data[4:], len(data) - 4)
+                gl.glGetProgramiv(program_name, gl.GL_LINK_STATUS, ctypes.byref(success))
+            except gl.GLException:
+                pass
+
+        if not success:
+            self.misses += 1
+            self.rejected += 1
+            return False
+        self.hits += 1
+        return True
+
+
+    def prepare(self, program_name):
+        '''
+        Request a retrievable binary, must be called before linking.
+        '''
+        if self.supported():
+            gl.glProgramParameteri(program_name, gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, gl.GL_TRUE)
+
+
+    def store(self, program_name, key):
+        '''
+        Write the binary of a linked program to the cache.
+        '''
+        if not self.supported():
+            return
+        length = gl.GLint(0)
+        gl.glGetProgramiv(program_name, gl.GL_PROGRAM_BINARY_LENGTH, ctypes.byref(length))
+        if not length.value:
+            return
+        binary = ctypes.create_string_buffer(length.value)
+        binary_format = gl.GLenum(0)
+        written = gl.GLint(0)
+        gl.glGetProgramBinary(program_name, length, ctypes.byref(written), ctypes.byref(binary_format), binary)
+
+        # write to a temporary file first so concurrent processes never read partial files
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = '%s.%d.tmp' % (self.path(key), os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(struct.pack('<I', binary_format.value))
+            f.write(binary.raw[:written.value])
+        os.replace(temp_path, self.path(key))
+
+
+# uniform type: (ctype, components, matrix columns or 0)
+UNIFORM_TYPES = {
+    gl.GL_FLOAT: (gl.GLfloat, 1, 0),
+    gl.GL_FLOAT_VEC2: (gl.GLfloat, 2, 0),
+    gl.GL_FLOAT_VEC3: (gl.GLfloat, 3, 0),
+    gl.GL_FLOAT_VEC4: (gl.GLfloat, 4, 0),
+    gl.GL_INT: (gl.GLint, 1, 0),
+    gl.GL_INT_VEC2: (gl.GLint, 2, 0),
+    gl.GL_INT_VEC3: (gl.GLint, 3, 0),
+    gl.GL_INT_VEC4: (gl.GLint, 4, 0),
+    gl.GL_UNSIGNED_INT: (gl.GLuint, 1, 0),
+    gl.GL_UNSIGNED_INT_VEC2: (gl.GLuint, 2, 0),
+    gl.GL_UNSIGNED_INT_VEC3: (gl.GLuint, 3, 0),
+    gl.GL_UNSIGNED_INT_VEC4: (gl.GLuint, 4, 0),
+    gl.GL_BOOL: (gl.GLint, 1, 0),
+    gl.GL_BOOL_VEC2: (gl.GLint, 2, 0),
+    gl.GL_BOOL_VEC3: (gl.GLint, 3, 0),
+    gl.GL_BOOL_VEC4: (gl.GLint, 4, 0),
+    gl.GL_DOUBLE: (gl.GLdouble, 1, 0),
+    gl.GL_DOUBLE_VEC2: (gl.GLdouble, 2, 0),
+    gl.GL_DOUBLE_VEC3: (gl.GLdouble, 3, 0),
+    gl.GL_DOUBLE_VEC4: (gl.GLdouble, 4, 0),
+    # matrices have columns columns of components // columns rows each
+    gl.GL_FLOAT_MAT2: (gl.GLfloat, 4, 2),
+    gl.GL_FLOAT_MAT3: (gl.GLfloat, 9, 3),
+    gl.GL_FLOAT_MAT4: (gl.GLfloat, 16, 4),
+    gl.GL_FLOAT_MAT2x3: (gl.GLfloat, 6, 2),
+    gl.GL_FLOAT_MAT2x4: (gl.GLfloat, 8, 2),
+    gl.GL_FLOAT_MAT3x2: (gl.GLfloat, 6, 3),
+    gl.GL_FLOAT_MAT3x4: (gl.GLfloat, 12, 3),
+    gl.GL_FLOAT_MAT4x2: (gl.GLfloat, 8, 4),
+    gl.GL_FLOAT_MAT4x3: (gl.GLfloat, 12, 4),
+    gl.GL_DOUBLE_MAT2: (gl.GLdouble, 4, 2),
+    gl.GL_DOUBLE_MAT3: (gl.GLdouble, 9, 3),
+    gl.GL_DOUBLE_MAT4: (gl.GLdouble, 16, 4),
+    gl.GL_DOUBLE_MAT2x3: (gl.GLdouble, 6, 2),
+    gl.GL_DOUBLE_MAT2x4: (gl.GLdouble, 8, 2),
+    gl.GL_DOUBLE_MAT3x2: (gl.GLdouble, 6, 3),
+    gl.GL_DOUBLE_MAT3x4: (gl.GLdouble, 12, 3),
+    gl.GL_DOUBLE_MAT4x2: (gl.GLdouble, 8, 4),
+    gl.GL_DOUBLE_MAT4x3: (gl.GLdouble, 12, 4),
+}
+
+# samplers and images are set like an int
+SAMPLER_TYPE = (gl.GLint, 1, 0)
+SAMPLER_TYPES = frozenset(value for name, value in vars(gl.gl).items()
+                          if re.match(r'GL_(UNSIGNED_INT_|INT_)?(SAMPLER|IMAGE)_(1D|2D|3D|CUBE|BUFFER)', name))
+
+UNIFORM_SUFFIX = {gl.GLfloat: 'f', gl.GLdouble: 'd', gl.GLint: 'i', gl.GLuint: 'ui'}
+
+
+def uniform_setter(uniform_type):
+    '''
+    Return (ctype, components, glUniform* function) for a uniform type.
+    '''
+    if uniform_type in SAMPLER_TYPES:
+        ctype, components, columns = SAMPLER_TYPE
+    elif uniform_type in UNIFORM_TYPES:
+        ctype, components, columns = UNIFORM_TYPES[uniform_type]
+    else:
+        raise ValueError('Uniforms of type 0x%04x are not supported.' % uniform_type)
+    suffix = UNIFORM_SUFFIX[ctype]
+    if not columns:
+        return ctype, components, getattr(gl, 'glUniform%d%sv' % (components, suffix))
+    rows = components // columns
+    shape = '%d' % columns if rows == columns else '%dx%d' % (columns, rows)
+    setter = getattr(gl, 'glUniformMatrix%s%sv' % (shape, suffix))
+    return ctype, components, lambda location, count, data: setter(location, count, False, data)
+
+
+def _flatten(values):
+    '''
+    Return nested sequences of numbers as a flat tuple.
+    '''
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return tuple(values.ravel().tolist())
+    if isinstance(values, (tuple, list)):
+        return tuple(item for value in values for item in _flatten(value))
+    return (values,)
+
+
 class ShaderProgram:
-    def __init__(self, vertex_shader, fragment_shader, attributes):
-        # compile and link
-        self.program_name = gl.glCreateProgram()
-        gl.glAttachShader(self.program_name, compile_shader(gl.GL_VERTEX_SHADER, vertex_shader))
-        gl.glAttachShader(self.program_name, compile_shader(gl.GL_FRAGMENT_SHADER, fragment_shader))
-        link_program(self.program_name)
-
-        # vertex type
-        class VERTEX(ctypes.Structure):
-            _fields_ = [ (name, TYPE_NAME_TO_TYPE[tname] * size)
-                        for (name, tname, size) in attributes ]
-        self.VERTEX = VERTEX
+    '''
+    A linked glsl program together with a vertex array and buffer
+    for its attributes.
+
+    With deferred=True the shaders are only submitted to the driver,
+    compile and link status are checked when the program is first used
+    (or by calling finish).
+
+    instance_attributes are laid out in a second buffer and advance
+    once per instance, see send_instance_data and draw_instanced.
+
+    Attributes are given as (name, type, size) or (name, type, size,
+    normalized) tuples. With normalized set, integer values are mapped to
+    [0, 1] (unsigned) or [-1, 1] (signed) in the shader.
+
+    The active uniforms are looked up once after linking, set_uniform
+    only calls into GL when a value changes.
+    '''
+    def __init__(self, vertex_shader, fragment_shader, attributes,
+                 stream_vertices=0, stream_regions=3, cache=None, deferred=False,
+                 instance_attributes=None):
+        # compile and link, unless a cached binary can be used
+        with startup.phase('compile shaders'):
+            self.program_name = gl.glCreateProgram()
+            self.cache = cache
+            self.cache_key = cache.key(vertex_shader, fragment_shader) if cache else None
+            self.shaders = []
+            if not (cache and cache.load(self.program_name, self.cache_key)):
+                self.shaders = [submit_shader(gl.GL_VERTEX_SHADER, vertex_shader),
+                                submit_shader(gl.GL_FRAGMENT_SHADER, fragment_shader)]
+                for shader_name in self.shaders:
+                    gl.glAttachShader(self.program_name, shader_name)
+                if cache:
+                    cache.prepare(self.program_name)
+                gl.glLinkProgram(self.program_name)
+
+        # vertex and instance types
+        self.VERTEX = VERTEX = struct_type('VERTEX', attributes)
+        self.attributes = VERTEX.attributes
+        self.INSTANCE = struct_type('INSTANCE', instance_attributes) if instance_attributes else None
+        self.instance_attributes = self.INSTANCE.attributes if self.INSTANCE else []
+        self.vertex_count = 0
+        self.instance_count = 0
+        self.index_buffer = None
 
         # vertex array and buffer
         self.vertex_array_name = gl.GLuint(0)
-        self.vertex_buffer_name = gl.GLuint(0)
         gl.glGenVertexArrays(1, ctypes.byref(self.vertex_array_name))
-        gl.glGenBuffers(1, ctypes.byref(self.vertex_buffer_name))
-
-        gl.glBindVertexArray(self.vertex_array_name)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer_name)
-        for (name, tname, size) in attributes:
-            location = gl.glGetAttribLocation(self.program_name,
-                                              ctypes.create_string_buffer(name.encode('ascii')))
+        if stream_vertices:
+            self.stream = StreamBuffer(stream_vertices * ctypes.sizeof(VERTEX), stream_regions)
+            self.vertex_buffer_name = self.stream.name
+        else:
+            self.stream = None
+            self.vertex_buffer_name = gl.GLuint(0)
+            gl.glGenBuffers(1, ctypes.byref(self.vertex_buffer_name))
+        self.instance_buffer_name = None
+        if self.INSTANCE:
+            self.instance_buffer_name = gl.GLuint(0)
+            gl.glGenBuffers(1, ctypes.byref(self.instance_buffer_name))
+
+        self.buffer_sizes = {}
+        registry.add(self)
+
+        self.ready = False
+        if not deferred:
+            self.finish()
+
+
+    def is_complete(self):
+        '''
+        Return False while the driver is still compiling the program
+        in the background, without blocking.
+        '''
+        if self.ready or not _parallel_compile:
+            return True
+        status = gl.GLint(0)
+        gl.glGetProgramiv(self.program_name, GL_COMPLETION_STATUS_KHR, ctypes.byref(status))
+        return bool(status)
+
+
+    def finish(self):
+        '''
+        Wait for compiling and linking to complete, report errors and
+        set up the vertex array.
+        '''
+        if self.ready:
+            return
+        with startup.phase('compile shaders'):
+            if self.shaders:
+                for shader_name in self.shaders:
+                    check_shader(shader_name)
+                check_program(self.program_name)
+                if self.cache:
+                    self.cache.store(self.program_name, self.cache_key)
+                # the linked program keeps what it needs, the shader objects can go
+                for shader_name in self.shaders:
+                    gl.glDetachShader(self.program_name, shader_name)
+                    gl.glDeleteShader(shader_name)
+                self.shaders = []
+
+            self.attribute_locations = {}
+            for (name, tname, size, normalized) in self.attributes + self.instance_attributes:
+                location = gl.glGetAttribLocation(self.program_name,
+                                                  ctypes.create_string_buffer(name.encode('ascii')))
+                if location < 0:
+                    warnings.warn('Attribute %r is not present.' % name, stacklevel=_stacklevel())
+                    continue
+                self.attribute_locations[name] = location
+
+            self._introspect_uniforms()
+        self.ready = True
+        self.setup_vertex_array(self.vertex_array_name, self.vertex_buffer_name,
+                                self.instance_buffer_name)
+
+
+    def setup_vertex_array(self, vertex_array_name, vertex_buffer_name, instance_buffer_name=None):
+        '''
+        Point the attributes of the vertex array to the VERTEX structures
+        in the vertex buffer and the INSTANCE structures in the instance buffer.
+        '''
+        self.finish()
+        state = current_state()
+        state.bind_vertex_array(vertex_array_name)
+        state.bind_buffer(gl.GL_ARRAY_BUFFER, vertex_buffer_name)
+        self._set_attribute_pointers(self.attributes, self.VERTEX, 0)
+        if instance_buffer_name is not None:
+            state.bind_buffer(gl.GL_ARRAY_BUFFER, instance_buffer_name)
+            self._set_attribute_pointers(self.instance_attributes, self.INSTANCE, 1)
+        state.bind_vertex_array(0)
+        if state.unbind_on_exit:
+            state.bind_buffer(gl.GL_ARRAY_BUFFER, 0)
+
+
+    def vertex_groups(self, groups=None):
+        '''
+        Return struct types splitting the VERTEX attributes into separate
+        buffers, one per group of attribute names, e.g.
+        [('position',), ('color', 'texcoord')]. By default each
+        attribute gets a buffer of its own.
+        '''
+        specs = collections.OrderedDict((attribute[0], attribute) for attribute in self.attributes)
+        if groups is None:
+            groups = [(name,) for name in specs]
+        structs = []
+        for group in groups:
+            if isinstance(group, str):
+                group = (group,)
+            for name in group:
+                if name not in specs:
+                    raise ValueError('Attribute %r is not part of the vertex layout.' % name)
+            structs.append(struct_type('VERTEX_' + '_'.join(group), [specs[name] for name in group]))
+        return structs
+
+
+    def setup_vertex_groups(self, vertex_array_name, buffers):
+        '''
+        Point the attributes of the vertex array into separate buffers,
+        given as (buffer name, struct type) pairs, see vertex_groups.
+        '''
+        self.finish()
+        state = current_state()
+        state.bind_vertex_array(vertex_array_name)
+        for buffer_name, layout in buffers:
+            state.bind_buffer(gl.GL_ARRAY_BUFFER, buffer_name)
+            self._set_attribute_pointers(layout.attributes, layout, 0)
+        state.bind_vertex_array(0)
+        if state.unbind_on_exit:
+            state.bind_buffer(gl.GL_ARRAY_BUFFER, 0)
+
+
+    def _introspect_uniforms(self):
+        self.uniforms = {}
+        self.uniform_values = {}
+        count = gl.GLint(0)
+        gl.glGetProgramiv(self.program_name, gl.GL_ACTIVE_UNIFORMS, ctypes.byref(count))
+        max_length = gl.GLint(0)
+        gl.glGetProgramiv(self.program_name, gl.GL_ACTIVE_UNIFORM_MAX_LENGTH, ctypes.byref(max_length))
+        name_buffer = ctypes.create_string_buffer(max_length.value + 1)
+        length = gl.GLsizei(0)
+        size = gl.GLint(0)
+        uniform_type = gl.GLenum(0)
+        for index in range(count.value):
+            gl.glGetActiveUniform(self.program_name, index, len(name_buffer), ctypes.byref(length),
+                                  ctypes.byref(size), ctypes.byref(uniform_type), name_buffer)
+            location = gl.glGetUniformLocation(self.program_name, name_buffer)
             if location < 0:
-                warnings.warn('Attribute %r is not present.' % name, stacklevel=2)
+                # members of uniform blocks have no location
                 continue
+            name = name_buffer.value.decode('ascii')
+            if name.endswith('[0]'):
+                name = name[:-3]
+            self.uniforms[name] = (location, uniform_type.value, size.value)
+
+
+    def set_uniform(self, name, *values):
+        '''
+        Set a uniform of the program, e.g. set_uniform('offset', 0.5, 0.25).
+
+        Vectors may also be given as one sequence, matrices in column major
+        order and arrays flattened or as nested sequences.
+        '''
+        self.finish()
+        values = _flatten(values)
+        if self.uniform_values.get(name) == values:
+            return
+        if name not in self.uniforms:
+            warnings.warn('Uniform %r is not present.' % name, stacklevel=2)
+            return
+        location, uniform_type, size = self.uniforms[name]
+        try:
+            ctype, components, setter = uniform_setter(uniform_type)
+        except ValueError as error:
+            raise ValueError('Uniform %r: %s' % (name, error))
+        count = len(values) // components
+        if count * components != len(values) or not count:
+            raise ValueError('Wrong number of values for uniform %r.' % name)
+        # GL reports the used part of an array, values for the unused elements are dropped
+        count = min(count, size)
+        data = (ctype * (count * components))(*values[:count * components])
+
+        state = current_state()
+        previous_program = state.program
+        state.use_program(self.program_name)
+        setter(location, count, data)
+        if previous_program is not None:
+            state.use_program(previous_program)
+        self.uniform_values[name] = values
+
+
+    def bind_uniform_block(self, block_name, binding):
+        '''
+        Let the uniform block of the program read from the UniformBlock
+        bound to binding.
+        '''
+        self.finish()
+        index = gl.glGetUniformBlockIndex(self.program_name,
+                                          ctypes.create_string_buffer(block_name.encode('ascii')))
+        if index == gl.GL_INVALID_INDEX:
+            warnings.warn('Uniform block %r is not present.' % block_name, stacklevel=2)
+            return
+        gl.glUniformBlockBinding(self.program_name, index, binding)
+
+
+    def _set_attribute_pointers(self, attributes, struct, divisor):
+        for (name, tname, size, normalized) in attributes:
+            if name not in self.attribute_locations:
+                continue
+            location = self.attribute_locations[name]
             gl.glEnableVertexAttribArray(location)
-            gl.glVertexAttribPointer(location, size, tname, False,
-                                     ctypes.sizeof(VERTEX),
-                                     ctypes.c_void_p(getattr(VERTEX, name).offset))
-        gl.glBindVertexArray(0)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+            gl.glVertexAttribPointer(location, size, tname, normalized,
+                                     ctypes.sizeof(struct),
+                                     ctypes.c_void_p(getattr(struct, name).offset))
+            if divisor:
+                gl.glVertexAttribDivisor(location, divisor)
+
+
+    def set_index_buffer(self, index_buffer):
+        '''
+        Bind an IndexBuffer into the vertex array for draw_elements.
+        '''
+        self.finish()
+        self.index_buffer = index_buffer
+        index_buffer.bind_to(self.vertex_array_name)
 
 
     def __enter__(self):
-        gl.glUseProgram(self.program_name)
-        gl.glBindVertexArray(self.vertex_array_name)
+        self.finish()
+        state = current_state()
+        state.use_program(self.program_name)
+        state.bind_vertex_array(self.vertex_array_name)
 
     def __exit__(self, *unused):
-        gl.glUseProgram(0)
-        gl.glBindVertexArray(0)
+        state = current_state()
+        if state.unbind_on_exit:
+            state.use_program(0)
+            state.bind_vertex_array(0)
+
+
+    def pack(self, data, struct=None):
+        '''
+        Return data as a contiguous buffer of VERTEX structures
+        (or of the given struct type, e.g. INSTANCE).
+
+        Objects supporting the buffer protocol (numpy arrays of
+        vertex_dtype(self), ctypes arrays of VERTEX, bytes, or any other
+        C-contiguous array holding the bytes of the layout, e.g. a float32
+        (n, 4) array for copy_program) are returned unchanged, sequences
+        of vertex tuples are converted.
+        Structured numpy arrays with the same field names but other types,
+        e.g. float colors for a normalized byte attribute, are quantized.
+        '''
+        struct = struct or self.VERTEX
+        if numpy is not None and isinstance(data, numpy.ndarray) and data.dtype.names is not None:
+            dtype = struct_dtype(struct)
+            if data.dtype == dtype:
+                return data
+            if set(data.dtype.names) != set(dtype.names):
+                raise TypeError('Array dtype %r does not match the vertex layout.' % data.dtype)
+            return quantize_array(data, struct)
+        try:
+            view = memoryview(data)
+        except TypeError:
+            return (struct * len(data))(*data)
+        if not view.c_contiguous:
+            raise ValueError('Buffer must be C-contiguous.')
+        if view.nbytes % ctypes.sizeof(struct):
+            raise ValueError('Buffer size is not a multiple of the vertex size.')
+        return data
 
 
     def send_data(self, data):
-        data = (self.VERTEX * len(data))(*data)
+        '''
+        Upload vertex data and return the index of the first vertex
+        to pass to glDrawArrays.
+
+        Streaming programs append the data to the current region of their
+        StreamBuffer, all others replace the contents of the vertex buffer.
+        '''
+        data = self.pack(data)
+        stride = ctypes.sizeof(self.VERTEX)
+        self.vertex_count = memoryview(data).nbytes // stride
+        if self.stream:
+            return self.stream.write(data, stride) // stride
+
+        self._upload(self.vertex_buffer_name, data)
+        return 0
+
+
+    def send_instance_data(self, data):
+        '''
+        Replace the per-instance data used by draw_instanced.
+        '''
+        data = self.pack(data, self.INSTANCE)
+        self.instance_count = memoryview(data).nbytes // ctypes.sizeof(self.INSTANCE)
+        self._upload(self.instance_buffer_name, data)
+
+
+    def _upload(self, buffer_name, data):
+        pointer, size = buffer_pointer(data)
+        state = current_state()
+        state.bind_buffer(gl.GL_ARRAY_BUFFER, buffer_name)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, size, pointer, gl.GL_DYNAMIC_DRAW)
+        if state.unbind_on_exit:
+            state.bind_buffer(gl.GL_ARRAY_BUFFER, 0)
+        self.buffer_sizes[_value(buffer_name)] = size
+        registry.resize(self, sum(self.buffer_sizes.values()))
+
+
+    def draw_instanced(self, count=None, mode=gl.GL_TRIANGLES, first=0, vertex_count=None):
+        '''
+        Draw count instances (by default all sent with send_instance_data)
+        of the vertices sent last with send_data.
+        '''
+        if count is None:
+            count = self.instance_count
+        with self:
+            if self.index_buffer:
+                index_buffer = self.index_buffer
+                if vertex_count is None:
+                    vertex_count = index_buffer.count - first
+                gl.glDrawElementsInstanced(mode, vertex_count, index_buffer.type,
+                                           index_buffer.offset(first), count)
+            else:
+                if vertex_count is None:
+                    vertex_count = self.vertex_count
+                gl.glDrawArraysInstanced(mode, first, vertex_count, count)
+
+
+    def draw_elements(self, mode=gl.GL_TRIANGLES, first=0, count=None):
+        '''
+        Draw count indices (by default all) from the bound IndexBuffer,
+        starting at index first.
+        '''
+        if count is None:
+            count = self.index_buffer.count - first
+        with self:
+            gl.glDrawElements(mode, count, self.index_buffer.type, self.index_buffer.offset(first))
+
+
+    def end_frame(self):
+        '''
+        Advance a streaming program to the next region of its buffer.
+        '''
+        if self.stream:
+            self.stream.end_frame()
+
+
+    def release(self):
+        '''
+        Delete the program, its vertex array and its buffers.
+        '''
+        state = current_state()
+        for shader_name in self.shaders:
+            gl.glDeleteShader(shader_name)
+        self.shaders = []
+        state.forget_program(self.program_name)
+        gl.glDeleteProgram(self.program_name)
+        state.forget_vertex_array(self.vertex_array_name)
+        gl.glDeleteVertexArrays(1, ctypes.byref(self.vertex_array_name))
+        if self.stream:
+            self.stream.release()
+        else:
+            state.forget_buffer(self.vertex_buffer_name)
+            gl.glDeleteBuffers(1, ctypes.byref(self.vertex_buffer_name))
+        if self.instance_buffer_name is not None:
+            state.forget_buffer(self.instance_buffer_name)
+            gl.glDeleteBuffers(1, ctypes.byref(self.instance_buffer_name))
+        registry.remove(self)
+
+
+def attribute_spec(attribute):
+    '''
+    Return an attribute as a (name, type, size, normalized) tuple.
+    '''
+    name, tname, size = attribute[:3]
+    normalized = bool(attribute[3]) if len(attribute) > 3 else False
+    if tname in PACKED_TYPES and size != 4:
+        raise ValueError('Attribute %r of a packed type must have size 4.' % name)
+    return (name, tname, size, normalized)
+
+
+def half_float_bits(value):
+    '''
+    Return the 16 bit pattern of a float as IEEE half float.
+    '''
+    return struct.unpack('<H', struct.pack('<e', value))[0]
+
+
+def pack_2_10_10_10(values, signed=True, normalized=True):
+    '''
+    Pack four components into the 32 bit GL_(UNSIGNED_)INT_2_10_10_10_REV
+    format, x in the lowest ten bits.
 
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vertex_buffer_name)
-        gl.glBufferData(gl.GL_ARRAY_BUFFER, ctypes.sizeof(data), data, gl.GL_DYNAMIC_DRAW)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+    Float components of normalized attributes are scaled to the integer
+    range first, integers are packed as they are.
+    '''
+    if signed:
+        scales, low = (511, 511, 511, 1), (-1.0, -1.0, -1.0, -1.0)
+    else:
+        scales, low = (1023, 1023, 1023, 3), (0.0, 0.0, 0.0, 0.0)
+    packed = 0
+    for i, value in enumerate(values):
+        if isinstance(value, float):
+            if normalized:
+                value = min(max(value, low[i]), 1.0) * scales[i]
+            value = int(round(value))
+        packed |= (value & (0x3FF if i < 3 else 0x3)) << (10 * i)
+    return packed
+
+
+def _converter(tname, normalized):
+    '''
+    Return a function converting the components of an attribute value
+    to the stored representation, or None if no conversion is needed.
+    '''
+    if tname == gl.GL_HALF_FLOAT:
+        return lambda values: tuple(half_float_bits(value) for value in values)
+    if tname in PACKED_TYPES:
+        signed = tname == gl.GL_INT_2_10_10_10_REV
+        return lambda values: values if isinstance(values, int) else pack_2_10_10_10(values, signed, normalized)
+    if tname in INTEGER_MAX:
+        high = INTEGER_MAX[tname]
+        low = -1.0 if TYPE_NAME_TO_DTYPE[tname][0] == 'i' else 0.0
+        if normalized:
+            quantize = lambda value: int(round(min(max(value, low), 1.0) * high))
+        else:
+            quantize = lambda value: int(round(value))
+        return lambda values: tuple(quantize(value) if isinstance(value, float) else value for value in values)
+    return None
+
+
+def _align(offset, alignment):
+    return -(-offset // alignment) * alignment
+
+
+def struct_type(name, attributes):
+    '''
+    Return a ctypes structure with one field per attribute.
+
+    Every field starts at a multiple of four bytes and the size is
+    rounded up to four bytes, padding fields are inserted where needed.
+    Packed attributes are a single GLuint. Float values given for half
+    float, integer or packed attributes are quantized on construction.
+    The normalized attribute specs are available as the attributes
+    class attribute.
+    '''
+    attributes = [attribute_spec(attribute) for attribute in attributes]
+    fields = []
+    converters = {}
+    offset = 0
+    for (attribute_name, tname, size, normalized) in attributes:
+        if tname in PACKED_TYPES:
+            ctype = TYPE_NAME_TO_TYPE[tname]
+        else:
+            ctype = TYPE_NAME_TO_TYPE[tname] * size
+        start = _align(offset, max(4, ctypes.alignment(ctype)))
+        if start > offset:
+            fields.append(('_pad%d' % offset, gl.GLubyte * (start - offset)))
+        fields.append((attribute_name, ctype))
+        offset = start + ctypes.sizeof(ctype)
+        converter = _converter(tname, normalized)
+        if converter:
+            converters[attribute_name] = converter
+    if offset % 4:
+        fields.append(('_pad%d' % offset, gl.GLubyte * (_align(offset, 4) - offset)))
+
+    namespace = {'_fields_': fields, 'attributes': attributes}
+    if converters or len(fields) != len(attributes):
+        names = [attribute[0] for attribute in attributes]
+
+        # positional values skip the padding fields
+        def __init__(self, *args, **kwargs):
+            values = dict(zip(names, args), **kwargs)
+            for attribute_name, converter in converters.items():
+                if attribute_name in values:
+                    values[attribute_name] = converter(values[attribute_name])
+            ctypes.Structure.__init__(self, **values)
+        namespace['__init__'] = __init__
+    return type(name, (ctypes.Structure,), namespace)
+
+
+def struct_dtype(struct):
+    '''
+    Return the numpy dtype of a struct_type, without the padding fields.
+
+    Half float attributes are float16 and packed attributes uint32.
+    '''
+    if numpy is None:
+        raise ImportError('numpy is required for struct_dtype')
+    names, formats, offsets = [], [], []
+    for (name, tname, size, normalized) in struct.attributes:
+        names.append(name)
+        dtype = TYPE_NAME_TO_DTYPE[tname]
+        formats.append(dtype if tname in PACKED_TYPES else (dtype, (size,)))
+        offsets.append(getattr(struct, name).offset)
+    return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                        'itemsize': ctypes.sizeof(struct)})
+
+
+def quantize_array(data, struct):
+    '''
+    Convert a structured numpy array, e.g. with float32 fields only,
+    into an array of struct_dtype(struct) with vectorized operations.
+    '''
+    result = numpy.zeros(data.shape, struct_dtype(struct))
+    for (name, tname, size, normalized) in struct.attributes:
+        result[name] = quantize_field(data[name], tname, normalized)
+    return result
+
+
+def quantize_field(values, tname, normalized):
+    '''
+    Convert a numpy array of attribute values to the stored
+    representation of the attribute type, see quantize_array.
+    '''
+    values = numpy.asarray(values)
+    if tname in PACKED_TYPES:
+        if values.dtype.kind == 'f':
+            signed = tname == gl.GL_INT_2_10_10_10_REV
+            scales = numpy.array((511, 511, 511, 1) if signed else (1023, 1023, 1023, 3))
+            if normalized:
+                values = numpy.clip(values, -1.0 if signed else 0.0, 1.0) * scales
+            values = numpy.rint(values).astype(numpy.int64)
+            values = ((values[..., 0] & 0x3FF) | (values[..., 1] & 0x3FF) << 10 |
+                      (values[..., 2] & 0x3FF) << 20 | (values[..., 3] & 0x3) << 30)
+        return values
+    if tname in INTEGER_MAX and values.dtype.kind == 'f':
+        if normalized:
+            low = -1.0 if TYPE_NAME_TO_DTYPE[tname][0] == 'i' else 0.0
+            values = numpy.clip(values, low, 1.0) * INTEGER_MAX[tname]
+        return numpy.rint(values)
+    return values
+
+
+def compile_programs(specs, **kwargs):
+    '''
+    Create a ShaderProgram for each (vertex_shader, fragment_shader, attributes)
+    tuple in specs.
+
+    All shaders are submitted before any status is queried, so the driver
+    can compile them in parallel while the caller goes on with other setup.
+    Errors are reported when a program is first used.
+    '''
+    enable_parallel_compile()
+    return [ShaderProgram(*spec, deferred=True, **kwargs) for spec in specs]
+
+
+def vertex_dtype(program):
+    '''
+    Return the numpy dtype matching the VERTEX layout of program.
+
+    Arrays of this dtype can be filled with vectorized code and passed
+    to program.send_data without copying.
+    '''
+    if numpy is None:
+        raise ImportError('numpy is required for vertex_dtype')
+    return struct_dtype(program.VERTEX)
+
+
+def buffer_pointer(data):
+    '''
+    Return a (pointer, size) pair for an object supporting the buffer
+    protocol, suitable for passing to glBufferData and friends.
+
+    The memory is not copied, except for read-only buffers other than
+    bytes or numpy arrays, which ctypes cannot point into.
+    '''
+    if isinstance(data, ctypes.Array):
+        return data, ctypes.sizeof(data)
+    view = memoryview(data)
+    if not view.c_contiguous:
+        raise ValueError('Buffer must be C-contiguous.')
+    if isinstance(data, bytes):
+        return data, view.nbytes
+    if numpy is not None and isinstance(data, numpy.ndarray):
+        return ctypes.c_void_p(data.ctypes.data), view.nbytes
+    if view.readonly:
+        return (ctypes.c_char * view.nbytes).from_buffer_copy(view), view.nbytes
+    return (ctypes.c_char * view.nbytes).from_buffer(view), view.nbytes
+
+
+class StaticBuffer:
+    '''
+    A buffer object which is uploaded once with GL_STATIC_DRAW.
+
+    users counts the owners of a buffer shared through static_buffer,
+    release() only deletes it when the last one releases it.
+    '''
+    def __init__(self, data):
+        pointer, self.size = buffer_pointer(data)
+        self.users = 1
+        self.key = None
+        self.name = gl.GLuint(0)
+        gl.glGenBuffers(1, ctypes.byref(self.name))
+        state = current_state()
+        state.bind_buffer(gl.GL_ARRAY_BUFFER, self.name)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, self.size, pointer, gl.GL_STATIC_DRAW)
+        if state.unbind_on_exit:
+            state.bind_buffer(gl.GL_ARRAY_BUFFER, 0)
+        registry.add(self, self.size)
+
+    def release(self):
+        self.users -= 1
+        if self.users:
+            return
+        if self.key is not None and _static_buffers.get(self.key) is self:
+            del _static_buffers[self.key]
+        current_state().forget_buffer(self.name)
+        gl.glDeleteBuffers(1, ctypes.byref(self.name))
+        registry.remove(self)
+
+
+_static_buffers = weakref.WeakValueDictionary()
+
+def static_buffer(data):
+    '''
+    Return a StaticBuffer holding data.
+
+    Buffers are shared by content hash, so identical data is only
+    uploaded once as long as a previous buffer is still alive.
+    Each caller owns one reference and releases it with release().
+    '''
+    key = hashlib.sha256(memoryview(data).cast('B')).digest()
+    buffer = _static_buffers.get(key)
+    if buffer is None:
+        buffer = StaticBuffer(data)
+        buffer.key = key
+        _static_buffers[key] = buffer
+    else:
+        buffer.users += 1
+    return buffer
+
+
+def quad_indices(quad_count):
+    '''
+    Return the indices splitting quads, given as four consecutive
+    vertices each, into two triangles.
+    '''
+    return [4 * quad + corner for quad in range(quad_count) for corner in (0, 1, 2, 0, 2, 3)]
+
+
+class IndexBuffer:
+    '''
+    Static element array buffer.
+
+    16 bit indices are used when they can address all vertices,
+    32 bit indices otherwise.
+    '''
+    def __init__(self, indices, vertex_count=None):
+        if vertex_count is None:
+            vertex_count = int(max(indices)) + 1 if len(indices) else 0
+        if vertex_count <= 0x10000:
+            self.type, ctype = gl.GL_UNSIGNED_SHORT, gl.GLushort
+        else:
+            self.type, ctype = gl.GL_UNSIGNED_INT, gl.GLuint
+        self.itemsize = ctypes.sizeof(ctype)
+        self.count = len(indices)
+
+        if numpy is not None and isinstance(indices, numpy.ndarray):
+            data = numpy.ascontiguousarray(indices, numpy.dtype(ctype))
+        else:
+            data = (ctype * self.count)(*indices)
+        # uploaded through GL_ARRAY_BUFFER, which does not need a vertex array bound
+        self.buffer = static_buffer(data)
+
+    def offset(self, first):
+        return ctypes.c_void_p(first * self.itemsize)
+
+    def bind_to(self, vertex_array_name):
+        state = current_state()
+        state.bind_vertex_array(vertex_array_name)
+        state.bind_buffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.buffer.name)
+        state.bind_vertex_array(0)
+
+    def release(self):
+        self.buffer.release()
+
+
+class Mesh:
+    '''
+    Vertex data in the layout of a ShaderProgram, uploaded once and
+    drawn with a single call.
+
+    Each mesh owns its vertex array, the vertex and index buffers are
+    shared between meshes with identical data.
+    '''
+    def __init__(self, program, data, mode=gl.GL_TRIANGLES, indices=None):
+        data = program.pack(data)
+        self.program = program
+        self.mode = mode
+        self.count = memoryview(data).nbytes // ctypes.sizeof(program.VERTEX)
+        self.buffer = static_buffer(data)
+
+        self.vertex_array_name = gl.GLuint(0)
+        gl.glGenVertexArrays(1, ctypes.byref(self.vertex_array_name))
+        program.setup_vertex_array(self.vertex_array_name, self.buffer.name)
+
+        self.index_buffer = None
+        if indices is not None:
+            self.index_buffer = IndexBuffer(indices, self.count)
+            self.index_buffer.bind_to(self.vertex_array_name)
+        registry.add(self)
+
+
+    def draw(self):
+        state = current_state()
+        state.use_program(self.program.program_name)
+        state.bind_vertex_array(self.vertex_array_name)
+        if self.index_buffer:
+            gl.glDrawElements(self.mode, self.index_buffer.count, self.index_buffer.type, None)
+        else:
+            gl.glDrawArrays(self.mode, 0, self.count)
+        if state.unbind_on_exit:
+            state.use_program(0)
+            state.bind_vertex_array(0)
+
+
+    def release(self):
+        '''
+        Delete the vertex array and release the buffers, the program is
+        not owned by the mesh.
+        '''
+        current_state().forget_vertex_array(self.vertex_array_name)
+        gl.glDeleteVertexArrays(1, ctypes.byref(self.vertex_array_name))
+        self.buffer.release()
+        if self.index_buffer:
+            self.index_buffer.release()
+        registry.remove(self)
+
+
+class ShadowBuffer:
+    '''
+    A vertex buffer of count structures with a copy in client memory.
+
+    Changes go to the client copy and record their range of vertices,
+    flush() uploads only the dirty ranges: with one glBufferSubData each,
+    or with mapped=True through a single glMapBufferRange with explicit
+    flushes. Ranges less than merge_gap bytes apart are uploaded together,
+    a few larger uploads being cheaper than many tiny ones.
+
+    data is the ctypes array of the client copy, with numpy also
+    available as the structured array array.
+    '''
+    def __init__(self, struct, count, mapped=False, merge_gap=64, usage=gl.GL_DYNAMIC_DRAW):
+        self.struct = struct
+        self.stride = ctypes.sizeof(struct)
+        self.count = count
+        self.specs = {attribute[0]: attribute for attribute in struct.attributes}
+        self.data = (struct * count)()
+        self.array = None
+        if numpy is not None:
+            self.array = numpy.frombuffer(memoryview(self.data).cast('B'), struct_dtype(struct))
+        self.dirty = []
+        self.mapped = mapped and (gl_info.have_version(3, 0) or
+                                  gl_info.have_extension('GL_ARB_map_buffer_range'))
+        self.merge_gap = merge_gap
+        self.uploaded = 0
+
+        self.name = gl.GLuint(0)
+        gl.glGenBuffers(1, ctypes.byref(self.name))
+        state = current_state()
+        state.bind_buffer(gl.GL_ARRAY_BUFFER, self.name)
+        # the buffer starts out equal to the client copy, so flushing the dirty ranges is enough
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, self.stride * count, self.data, usage)
+        if state.unbind_on_exit:
+            state.bind_buffer(gl.GL_ARRAY_BUFFER, 0)
+        registry.add(self, self.stride * count)
+
+
+    def mark(self, start, stop):
+        '''
+        Record that the vertices start to stop-1 were changed.
+        '''
+        start, stop = max(start, 0), min(stop, self.count)
+        if start < stop:
+            self.dirty.append((start, stop))
+
+    def mark_indices(self, indices):
+        '''
+        Record that the vertices at indices were changed, as few ranges
+        of consecutive indices.
+        '''
+        if numpy is not None:
+            indices = numpy.unique(numpy.asarray(indices, numpy.int64))
+            if not len(indices):
+                return
+            breaks = numpy.flatnonzero(numpy.diff(indices) != 1) + 1
+            starts = indices[numpy.concatenate([[0], breaks])]
+            stops = indices[numpy.concatenate([breaks - 1, [len(indices) - 1]])] + 1
+            self.dirty.extend(zip(starts.tolist(), stops.tolist()))
+            return
+        for index in sorted(set(indices)):
+            if self.dirty and self.dirty[-1][1] == index:
+                self.dirty[-1] = (self.dirty[-1][0], index + 1)
+            else:
+                self.dirty.append((index, index + 1))
+
+
+    def set(self, name, values, start=0):
+        '''
+        Change attribute name of the vertices from start on, one value
+        per vertex. Float values are quantized as for the VERTEX type.
+        '''
+        self._store(name, slice(start, start + len(values)), values)
+        self.mark(start, start + len(values))
+
+    def set_at(self, name, indices, values):
+        '''
+        Change attribute name of the vertices at indices.
+        '''
+        self._store(name, indices, values)
+        self.mark_indices(indices)
+
+    def _store(self, name, indices, values):
+        (name, tname, size, normalized) = self.specs[name]
+        if self.array is not None:
+            self.array[name][indices] = quantize_field(values, tname, normalized)
+            return
+        if isinstance(indices, slice):
+            indices = range(*indices.indices(self.count))
+        converter = _converter(tname, normalized)
+        for index, value in zip(indices, values):
+            setattr(self.data[index], name, converter(value) if converter else value)
+
+
+    def _ranges(self):
+        '''
+        Return the sorted dirty ranges, merged where they overlap or are
+        closer than merge_gap.
+        '''
+        gap = self.merge_gap // self.stride
+        ranges = []
+        for start, stop in sorted(self.dirty):
+            if ranges and start <= ranges[-1][1] + gap:
+                ranges[-1][1] = max(ranges[-1][1], stop)
+            else:
+                ranges.append([start, stop])
+        return ranges
+
+    def flush(self):
+        '''
+        Upload the dirty ranges and return the number of bytes sent.
+        '''
+        if not self.dirty:
+            return 0
+        ranges = self._ranges()
+        self.dirty = []
+        stride = self.stride
+        address = ctypes.addressof(self.data)
+        state = current_state()
+        state.bind_buffer(gl.GL_ARRAY_BUFFER, self.name)
+        if self.mapped:
+            first, last = ranges[0][0] * stride, ranges[-1][1] * stride
+            access = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_FLUSH_EXPLICIT_BIT
+            mapped = ctypes.cast(gl.glMapBufferRange(gl.GL_ARRAY_BUFFER, first, last - first, access),
+                                 ctypes.c_void_p).value
+            for start, stop in ranges:
+                size = (stop - start) * stride
+                ctypes.memmove(mapped + start * stride - first, address + start * stride, size)
+                gl.glFlushMappedBufferRange(gl.GL_ARRAY_BUFFER, start * stride - first, size)
+            gl.glUnmapBuffer(gl.GL_ARRAY_BUFFER)
+        else:
+            for start, stop in ranges:
+                gl.glBufferSubData(gl.GL_ARRAY_BUFFER, start * stride, (stop - start) * stride,
+                                   ctypes.c_void_p(address + start * stride))
+        if state.unbind_on_exit:
+            state.bind_buffer(gl.GL_ARRAY_BUFFER, 0)
+        size = sum(stop - start for start, stop in ranges) * stride
+        self.uploaded += size
+        return size
+
+
+    def release(self):
+        current_state().forget_buffer(self.name)
+        gl.glDeleteBuffers(1, ctypes.byref(self.name))
+        registry.remove(self)
+
+
+class DynamicMesh:
+    '''
+    Vertex data of a ShaderProgram which changes in parts, e.g. moving
+    positions with constant colors.
+
+    The attributes are split into one ShadowBuffer per group (see
+    ShaderProgram.vertex_groups), so changing one attribute uploads
+    only the changed vertices of its own buffer.
+
+        mesh = DynamicMesh(render_program, vertices, groups=['position', 'color'])
+        mesh.set_at('position', moved, new_positions)
+        mesh.draw()
+
+    draw() flushes the pending changes first.
+    '''
+    def __init__(self, program, data=None, count=None, groups=None, mode=gl.GL_TRIANGLES,
+                 indices=None, mapped=False, merge_gap=64):
+        if data is not None:
+            data = program.pack(data)
+            count = memoryview(data).nbytes // ctypes.sizeof(program.VERTEX)
+        self.program = program
+        self.mode = mode
+        self.count = count
+        self.buffers = [ShadowBuffer(struct, count, mapped, merge_gap)
+                        for struct in program.vertex_groups(groups)]
+        self.buffer_of = {attribute[0]: buffer for buffer in self.buffers
+                          for attribute in buffer.struct.attributes}
+
+        self.vertex_array_name = gl.GLuint(0)
+        gl.glGenVertexArrays(1, ctypes.byref(self.vertex_array_name))
+        program.setup_vertex_groups(self.vertex_array_name,
+                                    [(buffer.name, buffer.struct) for buffer in self.buffers])
+
+        self.index_buffer = None
+        if indices is not None:
+            self.index_buffer = IndexBuffer(indices, count)
+            self.index_buffer.bind_to(self.vertex_array_name)
+        if data is not None:
+            self.set_vertices(data)
+        registry.add(self)
+
+
+    def set_vertices(self, data, start=0):
+        '''
+        Change all attributes of the vertices from start on, data is
+        given as for ShaderProgram.send_data.
+        '''
+        data = self.program.pack(data)
+        if numpy is not None:
+            dtype = vertex_dtype(self.program)
+            if not isinstance(data, numpy.ndarray) or data.dtype != dtype:
+                data = numpy.frombuffer(memoryview(data).cast('B'), dtype)
+            for name, buffer in self.buffer_of.items():
+                buffer.set(name, data[name], start)
+            return
+        if not isinstance(data, ctypes.Array):
+            data = (self.program.VERTEX * (len(data) // ctypes.sizeof(self.program.VERTEX))).from_buffer_copy(data)
+        for name, buffer in self.buffer_of.items():
+            for index, vertex in enumerate(data, start):
+                setattr(buffer.data[index], name, getattr(vertex, name))
+            buffer.mark(start, start + len(data))
+
+    def set(self, name, values, start=0):
+        '''
+        Change one attribute of the vertices from start on.
+        '''
+        self.buffer_of[name].set(name, values, start)
+
+    def set_at(self, name, indices, values):
+        '''
+        Change one attribute of the vertices at indices.
+        '''
+        self.buffer_of[name].set_at(name, indices, values)
+
+    def flush(self):
+        '''
+        Upload all pending changes and return the number of bytes sent.
+        '''
+        return sum(buffer.flush() for buffer in self.buffers)
+
+
+    def draw(self):
+        self.flush()
+        state = current_state()
+        state.use_program(self.program.program_name)
+        state.bind_vertex_array(self.vertex_array_name)
+        if self.index_buffer:
+            gl.glDrawElements(self.mode, self.index_buffer.count, self.index_buffer.type, None)
+        else:
+            gl.glDrawArrays(self.mode, 0, self.count)
+        if state.unbind_on_exit:
+            state.use_program(0)
+            state.bind_vertex_array(0)
+
+
+    def release(self):
+        '''
+        Delete the vertex array and the buffers, the program is not
+        owned by the mesh.
+        '''
+        current_state().forget_vertex_array(self.vertex_array_name)
+        gl.glDeleteVertexArrays(1, ctypes.byref(self.vertex_array_name))
+        for buffer in self.buffers:
+            buffer.release()
+        if self.index_buffer:
+            self.index_buffer.release()
+        registry.remove(self)
+
+
+class UniformBlock:
+    '''
+    A uniform buffer object in std140 layout, shared by all programs
+    which bind their uniform block to the same binding point.
+
+        camera = UniformBlock([('projection', gl.GL_FLOAT_MAT4), ('time', gl.GL_FLOAT)], binding=1)
+        program.bind_uniform_block('Camera', 1)
+        camera.set('time', 1.5)
+        camera.upload()
+
+    Fields are (name, uniform type) or (name, uniform type, array length)
+    tuples. set() only changes the client copy, upload() sends the changed
+    bytes with a single glBufferSubData and binds the buffer.
+
+    Binding point 0 belongs to pyglet, whose windows bind their WindowBlock
+    (projection and view) there on every resize, so it is not accepted.
+    '''
+    def __init__(self, fields, binding=1, usage=gl.GL_DYNAMIC_DRAW):
+        if binding < 1:
+            raise ValueError('Uniform buffer binding 0 is reserved for the pyglet WindowBlock.')
+        self.binding = binding
+        self.layout = {}
+        offset = 0
+        for field in fields:
+            name, uniform_type = field[:2]
+            length = field[2] if len(field) > 2 else 1
+            ctype, components, columns = UNIFORM_TYPES[uniform_type]
+            if ctype is gl.GLdouble:
+                raise ValueError('Double field %r is not supported in a UniformBlock.' % name)
+            if columns or length > 1:
+                # array elements and matrix columns are padded to a vec4 each
+                element = components // columns if columns else components
+                slots = (columns or 1) * length
+                alignment = stride = 16
+            else:
+                element = components
+                slots = 1
+                alignment = {1: 4, 2: 8}.get(components, 16)
+                stride = 4 * components
+            offset = _align(offset, alignment)
+            self.layout[name] = (offset, ctype, element, slots, stride)
+            offset += slots * stride
+        self.size = _align(offset, 16)
+        self.data = ctypes.create_string_buffer(self.size)
+        self.values = {}
+        self.dirty = None
+
+        self.name = gl.GLuint(0)
+        gl.glGenBuffers(1, ctypes.byref(self.name))
+        state = current_state()
+        state.bind_buffer(gl.GL_UNIFORM_BUFFER, self.name)
+        gl.glBufferData(gl.GL_UNIFORM_BUFFER, self.size, self.data, usage)
+        if state.unbind_on_exit:
+            state.bind_buffer(gl.GL_UNIFORM_BUFFER, 0)
+        registry.add(self, self.size)
+
+
+    def set(self, name, *values):
+        '''
+        Change a field, the values are given as for ShaderProgram.set_uniform.
+        '''
+        values = _flatten(values)
+        if self.values.get(name) == values:
+            return
+        offset, ctype, element, slots, stride = self.layout[name]
+        if len(values) != element * slots:
+            raise ValueError('Wrong number of values for field %r.' % name)
+        for slot in range(slots):
+            (ctype * element).from_buffer(self.data, offset + slot * stride)[:] = \
+                values[slot * element:(slot + 1) * element]
+        self.values[name] = values
+
+        end = offset + (slots - 1) * stride + element * 4
+        if self.dirty:
+            offset, end = min(offset, self.dirty[0]), max(end, self.dirty[1])
+        self.dirty = (offset, end)
+
+
+    def upload(self):
+        '''
+        Send the changed fields to the buffer and bind it to its binding point.
+        '''
+        state = current_state()
+        if self.dirty:
+            start, end = self.dirty
+            state.bind_buffer(gl.GL_UNIFORM_BUFFER, self.name)
+            gl.glBufferSubData(gl.GL_UNIFORM_BUFFER, start, end - start,
+                               ctypes.byref(self.data, start))
+            self.dirty = None
+        state.bind_buffer_base(gl.GL_UNIFORM_BUFFER, self.binding, self.name)
+
+    def release(self):
+        current_state().forget_buffer(self.name)
+        gl.glDeleteBuffers(1, ctypes.byref(self.name))
+        registry.remove(self)
+
+
+class PassTimer:
+    '''
+    Measure the GPU time spent in a section of the frame.
 
+        with render_timer:
+            render_to_texture()
 
+    The section is bracketed by a pair of GL_TIMESTAMP queries taken from
+    a small ring. Results are only read once GL_QUERY_RESULT_AVAILABLE is
+    set, a few frames later, so the pipeline never stalls. When all pairs
+    are still in flight the section is simply not timed. Timers may be
+    nested.
+    '''
+    def __init__(self, name, queries=4, history=120):
+        self.name = name
+        query_names = (gl.GLuint * (2 * queries))()
+        gl.glGenQueries(2 * queries, query_names)
+        self.free = [(query_names[2 * i], query_names[2 * i + 1]) for i in range(queries)]
+        self.pending = collections.deque()
+        self.active = None
+        self.samples = collections.deque(maxlen=history)
+        registry.add(self)
+
+    def __enter__(self):
+        self.collect()
+        if self.free:
+            self.active = self.free.pop()
+            gl.glQueryCounter(self.active[0], gl.GL_TIMESTAMP)
+        return self
 
-def setup_render_program():
+    def __exit__(self, *unused):
+        if self.active:
+            gl.glQueryCounter(self.active[1], gl.GL_TIMESTAMP)
+            self.pending.append(self.active)
+            self.active = None
+
+
+    def collect(self, wait=False):
+        '''
+        Read back the results which are available without waiting,
+        or with wait set all pending results.
+        '''
+        available = gl.GLint(0)
+        start = gl.GLuint64(0)
+        end = gl.GLuint64(0)
+        while self.pending:
+            queries = self.pending[0]
+            if not wait:
+                gl.glGetQueryObjectiv(queries[1], gl.GL_QUERY_RESULT_AVAILABLE, ctypes.byref(available))
+                if not available.value:
+                    break
+            gl.glGetQueryObjectui64v(queries[0], gl.GL_QUERY_RESULT, ctypes.byref(start))
+            gl.glGetQueryObjectui64v(queries[1], gl.GL_QUERY_RESULT, ctypes.byref(end))
+            self.samples.append(end.value - start.value)
+            self.free.append(self.pending.popleft())
+
+
+    def release(self):
+        '''
+        Read the pending results and delete the queries.
+        '''
+        self.collect(wait=True)
+        queries = self.free + list(self.pending) + ([self.active] if self.active else [])
+        names = [name for pair in queries for name in pair]
+        gl.glDeleteQueries(len(names), (gl.GLuint * len(names))(*names))
+        self.free = []
+        self.pending.clear()
+        self.active = None
+        registry.remove(self)
+
+
+    def statistics(self):
+        '''
+        Return min, mean, p95 and max of the recent samples in milliseconds,
+        or None if there are no samples yet.
+        '''
+        self.collect()
+        if not self.samples:
+            return None
+        times = sorted(sample / 1e6 for sample in self.samples)
+        return {
+            'min': times[0],
+            'mean': sum(times) / len(times),
+            'p95': times[math.ceil(0.95 * len(times)) - 1],
+            'max': times[-1],
+        }
+
+    def __str__(self):
+        stats = self.statistics()
+        if stats is None:
+            return '%s: no samples' % self.name
+        return '{}: min {min:.3f} ms, mean {mean:.3f} ms, p95 {p95:.3f} ms, max {max:.3f} ms'.format(self.name, **stats)
+
+
+def setup_render_program(cache=None, deferred=False):
     '''
     Create the glsl program for rendering the colored triangle
     '''
@@ -163,10 +2209,10 @@ def setup_render_program():
 
     return ShaderProgram(vertex_shader, fragment_shader, [
         ('position', gl.GL_FLOAT, 2),
-        ('color', gl.GL_FLOAT, 4),
-    ])
+        ('color', gl.GL_UNSIGNED_BYTE, 4, True),
+    ], cache=cache, deferred=deferred)
 
-def setup_copy_program():
+def setup_copy_program(cache=None, deferred=False):
     '''
     Create the glsl copy_program for copying the rendered texture
     '''
@@ -196,120 +2242,558 @@ def setup_copy_program():
     return ShaderProgram(vertex_shader, fragment_shader, [
         ('position', gl.GL_FLOAT, 2),
         ('texcoord', gl.GL_FLOAT, 2),
-    ])
+    ], cache=cache, deferred=deferred)
+
+
+def setup_render_mesh(program):
+    '''
+    Create the mesh for the colored triangle
+    '''
+    return Mesh(program, [
+        ((-0.6, -0.5), (1.0, 0.0, 0.0, 1.0)),
+        ((0.6, -0.5), (0.0, 1.0, 0.0, 1.0)),
+        ((0.0, 0.5), (0.0, 0.0, 1.0, 1.0))])
+
+def setup_copy_mesh(program):
+    '''
+    Create the mesh for the quads showing the rendered texture
+    '''
+    return Mesh(program, [
+        ((-0.9, -0.9), (0.0, 0.0)),
+        ((0.5, -0.9), (1.0, 0.0)),
+        ((0.5, 0.5), (1.0, 1.0)),
+        ((-0.9, 0.5), (0.0, 1.0)),
+
+        ((0.6, 0.6), (0.0, 1.0)),
+        ((1.0, 0.6), (1.0, 1.0)),
+        ((1.0, 1.0), (1.0, 0.0)),
+        ((0.6, 1.0), (0.0, 0.0))], indices=quad_indices(2))
 
 
 def draw():
-    render_to_texture()
-    copy_texture_to_screen()
+    with render_timer:
+        render_to_texture()
+    with copy_timer:
+        copy_texture_to_screen()
+    startup.frame_done()
 
 
 def render_to_texture():
     # select the target to draw into
     with framebuffer:
-        gl.glViewport(0, 0, FB_WIDTH, FB_HEIGHT)
-
         # clear the destination
-        gl.glClearColor(0.5, 0.6, 0.7, 1.0)
+        current_state().set_clear_color(0.5, 0.6, 0.7, 1.0)
         gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
 
-        # send the vertex data
-        render_program.send_data([
-            ((-0.6, -0.5), (1.0, 0.0, 0.0, 1.0)),
-            ((0.6, -0.5), (0.0, 1.0, 0.0, 1.0)),
-            ((0.0, 0.5), (0.0, 0.0, 1.0, 1.0))])
-
-        # draw using the vertex array for vertex information
-        with render_program:
-            gl.glDrawArrays(gl.GL_TRIANGLES, 0, 3)
+        # draw the triangle uploaded at startup
+        render_mesh.draw()
 
 
 def copy_texture_to_screen():
     # clear the destination
-    gl.glClearColor(0.4, 0.4, 0.4, 1.0)
+    current_state().set_clear_color(0.4, 0.4, 0.4, 1.0)
     gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
 
-    # send the vertex data
-    copy_program.send_data([
-        ((-0.9, -0.9), (0.0, 0.0)),
-        ((0.5, -0.9), (1.0, 0.0)),
-        ((0.5, 0.5), (1.0, 1.0)),
-        ((-0.9, 0.5), (0.0, 1.0)),
+    # draw the quads uploaded at startup
+    copy_mesh.program.set_uniform('texture', framebuffer.rendered_texture.unit)
+    with framebuffer.rendered_texture:
+        copy_mesh.draw()
 
-        ((0.6, 0.6), (0.0, 1.0)),
-        ((1.0, 0.6), (1.0, 1.0)),
-        ((1.0, 1.0), (1.0, 0.0)),
-        ((0.6, 1.0), (0.0, 0.0))])
 
-    # draw
-    with copy_program, framebuffer.rendered_texture:
-        gl.glDrawArrays(gl.GL_QUADS, 0, 8)
+# components per pixel of the client pixel formats
+FORMAT_COMPONENTS = {
+    gl.GL_RED: 1,
+    gl.GL_RG: 2,
+    gl.GL_RGB: 3,
+    gl.GL_BGR: 3,
+    gl.GL_RGBA: 4,
+    gl.GL_BGRA: 4,
+}
 
 
 class Texture:
-    def __init__(self):
+    '''
+    A texture object bound to a texture unit while used in a with block.
+
+    allocate() creates immutable storage once, upload() replaces the whole
+    image or a sub-rectangle with glTexSubImage2D. Uploads pass through a
+    TextureUploader when one is given, so they do not wait for the GPU.
+    '''
+    def __init__(self, unit=0, target=gl.GL_TEXTURE_2D):
         self.name = gl.GLuint(0)
+        self.unit = unit
+        self.target = target
+        self.width = 0
+        self.height = 0
+        self.levels = 0
+        self.layers = 0
         gl.glGenTextures(1, ctypes.byref(self.name))
+        registry.add(self)
 
     def __enter__(self):
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.name)
+        current_state().bind_texture(self.target, self.name, self.unit)
 
     def __exit__(self, *unused):
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        state = current_state()
+        if state.unbind_on_exit:
+            state.bind_texture(self.target, 0, self.unit)
+
+    def allocate(self, width, height, internal_format=gl.GL_RGBA8, mipmaps=False, layers=0):
+        '''
+        Allocate storage for the image and, with mipmaps set, for a full
+        chain of mipmap levels. layers is the number of layers of a
+        GL_TEXTURE_2D_ARRAY texture.
+        '''
+        self.width = width
+        self.height = height
+        self.layers = layers
+        self.levels = int(math.log2(max(width, height))) + 1 if mipmaps else 1
+        with self:
+            allocate_texture_storage(self.target, self.levels, internal_format, width, height, layers=layers)
+            gl.glTexParameteri(self.target, gl.GL_TEXTURE_MIN_FILTER,
+                               gl.GL_LINEAR_MIPMAP_LINEAR if mipmaps else gl.GL_LINEAR)
+            gl.glTexParameteri(self.target, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+        # a full mipmap chain adds a third
+        size = width * height * max(1, layers) * INTERNAL_FORMAT_BYTES.get(internal_format, 4)
+        registry.resize(self, size * 4 // 3 if mipmaps else size)
+        return self
+
+
+    def upload(self, data, x=0, y=0, width=None, height=None, pixel_format=gl.GL_RGBA,
+               pixel_type=gl.GL_UNSIGNED_BYTE, uploader=None, generate_mipmap=False, layer=0):
+        '''
+        Replace a rectangle of the base level, by default the whole image,
+        with tightly packed rows of pixels, bottom row first. Array
+        textures are updated in the given layer.
+
+        data may be bytes, a numpy array or any other buffer. With
+        generate_mipmap set the other levels are recomputed afterwards.
+        '''
+        width = self.width - x if width is None else width
+        height = self.height - y if height is None else height
+        pointer, size = buffer_pointer(data)
+        expected = width * height * FORMAT_COMPONENTS[pixel_format] * ctypes.sizeof(TYPE_NAME_TO_TYPE[pixel_type])
+        if size != expected:
+            raise ValueError('Expected %d bytes of pixel data, got %d.' % (expected, size))
+
+        state = current_state()
+        with self:
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+            if uploader and uploader.stream.fits(size, 4):
+                offset = uploader.stream.write(data, 4)
+                state.bind_buffer(gl.GL_PIXEL_UNPACK_BUFFER, uploader.stream.name)
+                self._sub_image(x, y, layer, width, height, pixel_format, pixel_type, ctypes.c_void_p(offset))
+                # pixel pointers of other code (e.g. pyglet) would be taken as buffer offsets
+                state.bind_buffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+            else:
+                state.bind_buffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+                self._sub_image(x, y, layer, width, height, pixel_format, pixel_type, pointer)
+            if generate_mipmap and self.levels > 1:
+                gl.glGenerateMipmap(self.target)
+
+
+    def _sub_image(self, x, y, layer, width, height, pixel_format, pixel_type, pixels):
+        if self.layers:
+            gl.glTexSubImage3D(self.target, 0, x, y, layer, width, height, 1, pixel_format, pixel_type, pixels)
+        else:
+            gl.glTexSubImage2D(self.target, 0, x, y, width, height, pixel_format, pixel_type, pixels)
+
+
+    def release(self):
+        current_state().forget_texture(self.name)
+        gl.glDeleteTextures(1, ctypes.byref(self.name))
+        registry.remove(self)
+
+
+class TextureUploader:
+    '''
+    Stages texture uploads in a ring of pixel unpack buffer regions.
+
+    Texture.upload copies the pixels into the current region and returns,
+    the GPU transfers them into the texture asynchronously. Call
+    end_frame() once per frame, it only waits when the region written
+    regions frames ago is still in use. Images which do not fit into the
+    rest of the current region are uploaded directly from client memory.
+    '''
+    def __init__(self, region_size, regions=3):
+        self.stream = StreamBuffer(region_size, regions, gl.GL_PIXEL_UNPACK_BUFFER)
+
+    def upload(self, texture, data, *args, **kwargs):
+        texture.upload(data, *args, uploader=self, **kwargs)
+
+    def end_frame(self):
+        self.stream.end_frame()
+
+    def release(self):
+        self.stream.release()
+
+
+class PendingRead:
+    '''
+    Pixels being copied from a Framebuffer into a pixel pack buffer.
+
+    The copy completes asynchronously, done() tells without blocking
+    whether the pixels are available. Rows are in GL order, bottom row first.
+    '''
+    def __init__(self, buffer_name, width, height):
+        self.buffer_name = buffer_name
+        self.width = width
+        self.height = height
+        self.size = width * height * 4
+        self.fence = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.expired = False
+
+    def done(self):
+        if self.fence:
+            result = gl.glClientWaitSync(self.fence, 0, 0)
+            if result not in (gl.GL_ALREADY_SIGNALED, gl.GL_CONDITION_SATISFIED):
+                return False
+            gl.glDeleteSync(self.fence)
+            self.fence = None
+        return True
+
+    def wait(self):
+        if self.fence:
+            wait_sync(self.fence)
+            self.fence = None
+
+
+    @contextlib.contextmanager
+    def mapped(self):
+        '''
+        Wait for the pixels and yield a memoryview of the mapped buffer,
+        which is only valid inside the with block.
+        '''
+        if self.expired:
+            raise ValueError('The pack buffer of this read has been reused.')
+        self.wait()
+        state = current_state()
+        state.bind_buffer(gl.GL_PIXEL_PACK_BUFFER, self.buffer_name)
+        pointer = gl.glMapBufferRange(gl.GL_PIXEL_PACK_BUFFER, 0, self.size, gl.GL_MAP_READ_BIT)
+        view = memoryview((ctypes.c_ubyte * self.size).from_address(pointer)).cast('B')
+        try:
+            yield view
+        finally:
+            try:
+                view.release()
+            except BufferError:
+                pass
+            state.bind_buffer(gl.GL_PIXEL_PACK_BUFFER, self.buffer_name)
+            gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+            state.bind_buffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+
+    def result(self):
+        '''
+        Wait for the pixels and return a copy, as a (height, width, 4)
+        numpy array or as bytes if numpy is not available.
+        '''
+        with self.mapped() as view:
+            if numpy is None:
+                return bytes(view)
+            return numpy.frombuffer(view, numpy.uint8).reshape(self.height, self.width, 4).copy()
+
+
+def allocate_texture_storage(target, levels, internal_format, width, height, samples=0, layers=0):
+    '''
+    Allocate immutable storage for the bound texture, falling back to
+    mutable glTexImage2D storage when glTexStorage2D is not available.
+
+    With layers set the texture is a GL_TEXTURE_2D_ARRAY of that many layers.
+    '''
+    storage = gl_info.have_version(4, 2) or gl_info.have_extension('GL_ARB_texture_storage')
+    if samples:
+        if gl_info.have_version(4, 3) or gl_info.have_extension('GL_ARB_texture_storage_multisample'):
+            gl.glTexStorage2DMultisample(target, samples, internal_format, width, height, True)
+        else:
+            gl.glTexImage2DMultisample(target, samples, internal_format, width, height, True)
+    elif layers:
+        if storage:
+            gl.glTexStorage3D(target, levels, internal_format, width, height, layers)
+        else:
+            for level in range(levels):
+                gl.glTexImage3D(target, level, internal_format, max(1, width >> level), max(1, height >> level),
+                                layers, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
+    elif storage:
+        gl.glTexStorage2D(target, levels, internal_format, width, height)
+    else:
+        for level in range(levels):
+            gl.glTexImage2D(target, level, internal_format, max(1, width >> level), max(1, height >> level),
+                            0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
 
 
 class Framebuffer:
-    def __init__(self):
+    '''
+    Offscreen render target with a texture as color attachment and an
+    optional depth/stencil renderbuffer.
+
+    The size defaults to FB_WIDTH x FB_HEIGHT. Use a RenderTargetPool to
+    recycle targets instead of creating and releasing them repeatedly.
+
+    read_async() copies the pixels into a ring of pixel pack buffers, so
+    frame N can be read back while frame N+1 is rendered.
+    '''
+    def __init__(self, width=None, height=None, internal_format=gl.GL_RGBA8, samples=0,
+                 depth_stencil=False, read_buffers=2):
+        self.width = width or FB_WIDTH
+        self.height = height or FB_HEIGHT
+        self.key = (self.width, self.height, internal_format, samples, depth_stencil)
+        self.samples = samples
         self.framebuffer = gl.GLuint(0)
-        self.rendered_texture = Texture()
+        texture_target = gl.GL_TEXTURE_2D_MULTISAMPLE if samples else gl.GL_TEXTURE_2D
+        self.rendered_texture = Texture(target=texture_target)
+        self.depth_stencil = None
+        self.read_buffers = read_buffers
+        self.pack_buffers = []
+        self.pending_reads = []
+        self.next_read = 0
 
         gl.glGenFramebuffers(1, ctypes.byref(self.framebuffer))
 
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.framebuffer)
+        state = current_state()
+        state.bind_framebuffer(self.framebuffer)
 
         # Set up the texture as the target for color output
         with self.rendered_texture:
-            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, FB_WIDTH, FB_HEIGHT, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, 0)
-            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
-            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
-            gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_TEXTURE_2D, self.rendered_texture.name, 0)
+            allocate_texture_storage(texture_target, 1, internal_format, self.width, self.height, samples)
+            if not samples:
+                gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+                gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+            gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, texture_target, self.rendered_texture.name, 0)
+
+        if depth_stencil:
+            self.depth_stencil = gl.GLuint(0)
+            gl.glGenRenderbuffers(1, ctypes.byref(self.depth_stencil))
+            gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self.depth_stencil)
+            gl.glRenderbufferStorageMultisample(gl.GL_RENDERBUFFER, samples, gl.GL_DEPTH24_STENCIL8,
+                                                self.width, self.height)
+            gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, 0)
+            gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_STENCIL_ATTACHMENT,
+                                         gl.GL_RENDERBUFFER, self.depth_stencil)
+
+        # the draw buffers are part of the framebuffer state, set them once
+        draw_buffers = (gl.GLenum * 1)(gl.GL_COLOR_ATTACHMENT0)
+        gl.glDrawBuffers(1, draw_buffers)
 
         if gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER) != gl.GL_FRAMEBUFFER_COMPLETE:
             raise ValueError('Framebuffer not set up completely')
 
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        state.bind_framebuffer(0)
+
+        pixel_bytes = INTERNAL_FORMAT_BYTES.get(internal_format, 4) + (4 if depth_stencil else 0)
+        registry.add(self, self.width * self.height * max(1, samples) * pixel_bytes)
 
 
     def __enter__(self):
-        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.framebuffer)
-        draw_buffers = (gl.GLenum * 1)(gl.GL_COLOR_ATTACHMENT0)
-        gl.glDrawBuffers(1, draw_buffers)
-        gl.glViewport(0, 0, FB_WIDTH, FB_HEIGHT)
+        state = current_state()
+        state.bind_framebuffer(self.framebuffer)
+        state.set_viewport(0, 0, self.width, self.height)
 
 
     def __exit__(self, *unused):
+        state = current_state()
+        state.bind_framebuffer(0)
+        state.set_viewport(0, 0, window.width, window.height)
+
+
+    def release(self):
+        '''
+        Delete the GL objects of the framebuffer.
+        '''
+        state = current_state()
+        for read in self.pending_reads:
+            read.wait()
+            read.expired = True
+        self.pending_reads = []
+        self.next_read = 0
+        if self.pack_buffers:
+            for name in self.pack_buffers:
+                state.forget_buffer(name)
+            gl.glDeleteBuffers(len(self.pack_buffers), (gl.GLuint * len(self.pack_buffers))(*self.pack_buffers))
+            self.pack_buffers = []
+        if self.depth_stencil:
+            gl.glDeleteRenderbuffers(1, ctypes.byref(self.depth_stencil))
+        self.rendered_texture.release()
+        state.forget_framebuffer(self.framebuffer)
+        gl.glDeleteFramebuffers(1, ctypes.byref(self.framebuffer))
+        registry.remove(self)
+
+
+    def blit_to(self, other):
+        '''
+        Copy the color attachment into another framebuffer, resolving
+        multisampled targets.
+        '''
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.framebuffer)
+        gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, other.framebuffer)
+        gl.glBlitFramebuffer(0, 0, self.width, self.height, 0, 0, other.width, other.height,
+                             gl.GL_COLOR_BUFFER_BIT, gl.GL_NEAREST)
+        current_state().bind_framebuffer(0)
+        # both targets were bound behind the back of the state cache
         gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
-        gl.glViewport(0, 0, window.width, window.height)
-
 
-def main():
-    global window
-    window = pyglet.window.Window()
 
-    global framebuffer
-    framebuffer = Framebuffer()
+    def read_async(self):
+        '''
+        Start copying the RGBA pixels into the next pack buffer of the ring
+        and return a PendingRead handle.
+
+        A handle expires when its buffer is reused read_buffers calls later.
+        '''
+        if self.samples:
+            raise ValueError('Multisampled framebuffers must be resolved with blit_to before reading.')
+        state = current_state()
+        size = self.width * self.height * 4
+        if not self.pack_buffers:
+            names = (gl.GLuint * self.read_buffers)()
+            gl.glGenBuffers(self.read_buffers, names)
+            for name in names:
+                state.bind_buffer(gl.GL_PIXEL_PACK_BUFFER, name)
+                gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, size, None, gl.GL_STREAM_READ)
+            self.pack_buffers = list(names)
+
+        buffer_name = self.pack_buffers[self.next_read % self.read_buffers]
+        self.next_read += 1
+        # the oldest pending read owns the buffer, it must not see the new pixels
+        for previous in [read for read in self.pending_reads if read.buffer_name == buffer_name]:
+            self.pending_reads.remove(previous)
+            previous.wait()
+            previous.expired = True
+
+        previous_framebuffer = state.framebuffer
+        state.bind_framebuffer(self.framebuffer)
+        state.bind_buffer(gl.GL_PIXEL_PACK_BUFFER, buffer_name)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 4)
+        gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
+        state.bind_buffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        if previous_framebuffer is not None:
+            state.bind_framebuffer(previous_framebuffer)
+
+        read = PendingRead(buffer_name, self.width, self.height)
+        self.pending_reads.append(read)
+        return read
+
+
+class RenderTargetPool:
+    '''
+    Recycles Framebuffers by size, internal format, sample count and
+    depth/stencil attachment instead of reallocating them.
 
-    global render_program
-    render_program = setup_render_program()
+    At most max_free targets of each kind are kept for reuse, older
+    ones are released.
+    '''
+    def __init__(self, max_free=2):
+        self.max_free = max_free
+        self.free = collections.defaultdict(list)
+
+    def acquire(self, width, height, internal_format=gl.GL_RGBA8, samples=0, depth_stencil=False):
+        free = self.free[width, height, internal_format, samples, depth_stencil]
+        if free:
+            return free.pop()
+        return Framebuffer(width, height, internal_format, samples, depth_stencil)
+
+    def recycle(self, target):
+        free = self.free[target.key]
+        free.append(target)
+        while len(free) > self.max_free:
+            free.pop(0).release()
+
+    def trim(self):
+        '''
+        Release all targets which are not in use.
+        '''
+        for free in self.free.values():
+            for target in free:
+                target.release()
+        self.free.clear()
+
+
+class WindowTarget:
+    '''
+    A render target following the size of a window, scaled by scale.
 
-    global copy_program
-    copy_program = setup_copy_program()
+    The framebuffer is only exchanged when get() notices a size change,
+    the old one goes back to the pool so resizing back and forth
+    reuses earlier targets.
+    '''
+    def __init__(self, pool, window, scale=1.0, **format):
+        self.pool = pool
+        self.window = window
+        self.scale = scale
+        self.format = format
+        self.target = None
+
+    def get(self):
+        width = max(1, int(self.window.width * self.scale))
+        height = max(1, int(self.window.height * self.scale))
+        if self.target is None or (self.target.width, self.target.height) != (width, height):
+            if self.target is not None:
+                self.pool.recycle(self.target)
+            self.target = self.pool.acquire(width, height, **self.format)
+        return self.target
+
+
+def main(debug=False):
+    global window
+    with startup.phase('create context'):
+        if debug:
+            window = pyglet.window.Window(config=gl.Config(double_buffer=True, debug=True))
+            enable_debug_output()
+        else:
+            window = pyglet.window.Window()
+        enable_parallel_compile()
+    cache = ProgramCache(os.path.join(os.path.expanduser('~'), '.cache', 'glhelper'))
+
+    # both programs are submitted right away, the driver compiles them in parallel
+    # with the rest of the setup, their first use waits for them with finish()
+    global render_program, copy_program
+    render_program = setup_render_program(cache, deferred=True)
+    copy_program = setup_copy_program(cache, deferred=True)
+
+    # the other resources are declared here and created when the first frame uses them
+
+    global render_targets, framebuffer
+    render_targets = RenderTargetPool()
+    framebuffer = Lazy(render_targets.acquire, FB_WIDTH, FB_HEIGHT)
+
+    global render_mesh, copy_mesh
+    render_mesh = Lazy(setup_render_mesh, render_program)
+    copy_mesh = Lazy(setup_copy_mesh, copy_program)
+
+    global render_timer, copy_timer
+    render_timer = Lazy(PassTimer, 'render_to_texture')
+    copy_timer = Lazy(PassTimer, 'copy_texture_to_screen')
+
+    # all binds go through the state cache, so resetting them after each use is not needed
+    state = current_state()
+    state.unbind_on_exit = False
+    window.push_handlers(on_resize=lambda width, height: state.invalidate())
+
+    # release everything while the context still exists
+    def release_resources():
+        for resource in (render_mesh, copy_mesh, render_program, copy_program,
+                         render_timer, copy_timer, framebuffer):
+            resource.release()
+        render_targets.trim()
+    window.push_handlers(on_close=release_resources)
 
     print('OpenGL Version {}'.format(window.context.get_info().get_version()))
     window.on_draw = draw
-    pyglet.clock.schedule_interval(lambda dt: None, 0.01)
-    pyglet.app.run()
+    scheduler = FrameScheduler(window)
+    scheduler.run()
+
+    # the results of the last frames are still pending, unless on_close released the timers
+    for timer in (render_timer, copy_timer):
+        if timer.created:
+            timer.collect(wait=True)
+    print(startup)
+    print(scheduler)
+    print(render_timer)
+    print(copy_timer)
+    if _debug_output:
+        print(_debug_output.summary())
+    print(registry.report())
 
 
 if __name__ == '__main__':
-    main()
+    main(debug='--debug' in sys.argv[1:])
@@ -0,0 +1,239 @@
+'''
+Author: leovt (Leonhard Vogt)
+License: GNU GENERAL PUBLIC LICENSE - Version 3, 29 June 2007
+
+CPU-side profiling for the pyglet examples
+
+enable(module) replaces the `gl` module used by module with a stand-in
+which counts every GL call and the bytes uploaded by glBufferData,
+glBufferSubData, glTexImage2D and glTexSubImage2D. The draw stages are
+timed with perf_counter_ns. Nothing is patched until enable is called,
+so profiling costs nothing when it is disabled.
+
+    python glprofile.py trace.json
+
+runs the glhelper example with profiling and writes a Chrome trace_event
+file which can be loaded in chrome://tracing or Perfetto.
+'''
+
+import os
+import sys
+import json
+import time
+import collections
+from pyglet import gl
+
+
+BYTES_PER_COMPONENT = {
+    gl.GL_UNSIGNED_BYTE: 1,
+    gl.GL_BYTE: 1,
+    gl.GL_UNSIGNED_SHORT: 2,
+    gl.GL_SHORT: 2,
+    gl.GL_HALF_FLOAT: 2,
+    gl.GL_UNSIGNED_INT: 4,
+    gl.GL_INT: 4,
+    gl.GL_FLOAT: 4,
+}
+
+COMPONENTS = {
+    gl.GL_RED: 1,
+    gl.GL_RG: 2,
+    gl.GL_RGB: 3,
+    gl.GL_BGR: 3,
+    gl.GL_RGBA: 4,
+    gl.GL_BGRA: 4,
+    gl.GL_DEPTH_COMPONENT: 1,
+}
+
+
+def _is_null(pointer):
+    if isinstance(pointer, int):
+        return pointer == 0
+    return pointer is None or getattr(pointer, 'value', True) is None
+
+
+def _image_size(width, height, pixel_format, pixel_type, pixels):
+    if _is_null(pixels):
+        return 0
+    return width * height * COMPONENTS.get(pixel_format, 4) * BYTES_PER_COMPONENT.get(pixel_type, 1)
+
+
+# number of bytes uploaded by a call, computed from its arguments
+UPLOAD_SIZE = {
+    'glBufferData': lambda target, size, data, usage: 0 if _is_null(data) else size,
+    'glBufferSubData': lambda target, offset, size, data: size,
+    'glTexImage2D': lambda target, level, internalformat, width, height, border, pixel_format, pixel_type, pixels:
+        _image_size(width, height, pixel_format, pixel_type, pixels),
+    'glTexSubImage2D': lambda target, level, x, y, width, height, pixel_format, pixel_type, pixels:
+        _image_size(width, height, pixel_format, pixel_type, pixels),
+}
+
+
+class CountingGL:
+    '''
+    Stand-in for the pyglet.gl module which reports every call of a
+    GL function to a Profiler.
+    '''
+    def __init__(self, profiler, module=gl):
+        self._profiler = profiler
+        self._module = module
+
+    def __getattr__(self, name):
+        attr = getattr(self._module, name)
+        if name.startswith('gl') and callable(attr):
+            attr = self._wrap(name, attr)
+        elif not name.startswith('GL_'):
+            # module state such as current_context changes, look it up on every access
+            return attr
+        # cache functions and constants, so __getattr__ is only called once per name
+        setattr(self, name, attr)
+        return attr
+
+    def _wrap(self, name, function):
+        profiler = self._profiler
+        upload_size = UPLOAD_SIZE.get(name)
+
+        def counted(*args):
+            profiler.calls[name] += 1
+            if upload_size:
+                profiler.uploaded += upload_size(*args)
+            return function(*args)
+        return counted
+
+
+class Profiler:
+    '''
+    Collects GL call counts, uploaded bytes and stage timings per frame.
+    '''
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.uploaded = 0
+        self.frames = []
+        self.events = []
+        self.stages = {}
+        self.frame_start = None
+        self.origin = time.perf_counter_ns()
+
+    def _event(self, name, start, end, category):
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self.origin) / 1000,
+            'dur': (end - start) / 1000,
+            'pid': os.getpid(),
+            'tid': 0,
+        })
+
+
+    def begin_frame(self):
+        self.calls.clear()
+        self.uploaded = 0
+        self.stages = {}
+        self.frame_start = time.perf_counter_ns()
+
+    def end_frame(self):
+        end = time.perf_counter_ns()
+        self._event('frame %d' % len(self.frames), self.frame_start, end, 'frame')
+        self.frames.append({
+            'frame': len(self.frames),
+            'time_ms': (end - self.frame_start) / 1e6,
+            'gl_calls': sum(self.calls.values()),
+            'uploaded_bytes': self.uploaded,
+            'stages_ms': self.stages,
+            'calls': dict(self.calls),
+        })
+
+
+    def timed(self, name, function):
+        '''
+        Return a wrapper of function which records each call as a stage.
+        '''
+        def stage(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = time.perf_counter_ns()
+                self.stages[name] = self.stages.get(name, 0) + (end - start) / 1e6
+                self._event(name, start, end, 'stage')
+        return stage
+
+    def framed(self, function):
+        '''
+        Return a wrapper of function which records each call as a frame.
+        '''
+        def frame(*args, **kwargs):
+            self.begin_frame()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.end_frame()
+        return frame
+
+
+    def write_trace(self, path):
+        '''
+        Write the recorded frames and stages in Chrome trace_event format.
+        '''
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        '''
+        Return one line per recorded frame.
+        '''
+        lines = []
+        for frame in self.frames:
+            stages = ''.join(', %s %.3f ms' % item for item in frame['stages_ms'].items())
+            lines.append('frame %d: %.3f ms, %d GL calls, %d bytes uploaded%s' % (
+                frame['frame'], frame['time_ms'], frame['gl_calls'], frame['uploaded_bytes'], stages))
+        return '\n'.join(lines)
+
+
+_patched = {}
+
+def enable(module, stages=('render_to_texture', 'copy_texture_to_screen'), frame='draw', profiler=None):
+    '''
+    Instrument a module which uses pyglet.gl under the name gl.
+
+    The functions named in stages are timed, each call of the function
+    named frame is one frame. Return the Profiler collecting the results.
+    '''
+    if module in _patched:
+        raise ValueError('%s is already instrumented' % module.__name__)
+    profiler = profiler or Profiler()
+    originals = {'gl': module.gl}
+    module.gl = CountingGL(profiler, module.gl)
+    for name in stages:
+        originals[name] = getattr(module, name)
+        setattr(module, name, profiler.timed(name, originals[name]))
+    if frame:
+        originals[frame] = getattr(module, frame)
+        setattr(module, frame, profiler.framed(originals[frame]))
+    _patched[module] = originals
+    return profiler
+
+
+def disable(module):
+    '''
+    Restore the original functions of an instrumented module.
+    '''
+    for name, original in _patched.pop(module).items():
+        setattr(module, name, original)
+
+
+def main():
+    import glhelper
+    profiler = enable(glhelper)
+    try:
+        glhelper.main()
+    finally:
+        disable(glhelper)
+        print(profiler.summary())
+        if len(sys.argv) > 1:
+            profiler.write_trace(sys.argv[1])
+
+
+if __name__ == '__main__':
+    main()
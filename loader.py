@@ -0,0 +1,152 @@
+'''
+Author: leovt (Leonhard Vogt)
+License: GNU GENERAL PUBLIC LICENSE - Version 3, 29 June 2007
+
+Loading buffers and textures in the background
+
+A BackgroundLoader owns a hidden window whose context shares its objects
+with the main window. A loader thread creates and fills buffers and
+textures in that context while the main thread keeps rendering.
+
+    loader = BackgroundLoader(window)
+    future = loader.texture(pixels, 1024, 1024)
+    ...
+    # once per frame on the render thread
+    loader.poll()
+    if future.done():
+        texture = future.result()
+
+Every finished job is followed by a fence sync. Its future is only
+completed by poll() on the render thread, after the fence has been
+passed, so the render thread never sees half uploaded data.
+
+Only buffers, textures, shaders and programs are shared between contexts.
+Vertex arrays and framebuffers must be created on the render thread.
+'''
+
+import queue
+import threading
+import concurrent.futures
+from pyglet import gl
+import pyglet
+
+import glhelper
+
+
+class BackgroundLoader:
+    '''
+    Runs GL jobs on a thread with its own shared context.
+
+    The hidden window and its context are created on the calling (main)
+    thread, as most window systems require.
+    '''
+    def __init__(self, window):
+        self.main_context = window.context
+        context = window.context.config.create_context(window.context)
+        self.window = pyglet.window.Window(visible=False, context=context)
+        # creating the window made its context current
+        window.switch_to()
+
+        self.jobs = queue.Queue()
+        self.finished = queue.SimpleQueue()
+        self.fenced = []
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,), name='gl-loader', daemon=True)
+        self.thread.start()
+        ready.wait()
+
+
+    def _run(self, ready):
+        context = self.window.context
+        context.set_current()
+        # set_current also changed the global used on the main thread
+        gl.current_context = self.main_context
+        glhelper.set_thread_context(context)
+        ready.set()
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, function, args, kwargs = job
+            try:
+                result = function(*args, **kwargs)
+            except Exception as exception:
+                self.finished.put((future, None, None, exception))
+                continue
+            fence = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            # the fence must reach the GPU before another context can wait for it
+            gl.glFlush()
+            self.finished.put((future, fence, result, None))
+
+        gl.glFinish()
+        glhelper.set_thread_context(None)
+
+
+    def submit(self, function, *args, **kwargs):
+        '''
+        Call function on the loader thread and return a Future of its result.
+        '''
+        future = concurrent.futures.Future()
+        self.jobs.put((future, function, args, kwargs))
+        return future
+
+    def buffer(self, data):
+        '''
+        Upload data into a new glhelper.StaticBuffer.
+        '''
+        return self.submit(glhelper.StaticBuffer, data)
+
+    def texture(self, data, width, height, internal_format=gl.GL_RGBA8, pixel_format=gl.GL_RGBA,
+                pixel_type=gl.GL_UNSIGNED_BYTE, mipmaps=False, unit=0):
+        '''
+        Upload an image into a new glhelper.Texture, see Texture.upload.
+        '''
+        def load():
+            texture = glhelper.Texture(unit).allocate(width, height, internal_format, mipmaps)
+            texture.upload(data, pixel_format=pixel_format, pixel_type=pixel_type, generate_mipmap=mipmaps)
+            return texture
+        return self.submit(load)
+
+
+    def poll(self):
+        '''
+        Complete the futures of all jobs whose uploads the GPU has finished,
+        without blocking. Must be called on the render thread.
+        Return the number of completed jobs.
+        '''
+        while True:
+            try:
+                self.fenced.append(self.finished.get_nowait())
+            except queue.Empty:
+                break
+
+        completed = 0
+        waiting = []
+        for future, fence, result, exception in self.fenced:
+            if fence:
+                status = gl.glClientWaitSync(fence, 0, 0)
+                if status not in (gl.GL_ALREADY_SIGNALED, gl.GL_CONDITION_SATISFIED):
+                    waiting.append((future, fence, result, exception))
+                    continue
+                gl.glDeleteSync(fence)
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+            completed += 1
+        self.fenced = waiting
+        return completed
+
+    def pending(self):
+        return self.jobs.qsize() + self.finished.qsize() + len(self.fenced)
+
+
+    def close(self):
+        '''
+        Finish the queued jobs, stop the thread and destroy its context.
+        '''
+        self.jobs.put(None)
+        self.thread.join()
+        self.window.close()
+        self.main_context.set_current()
@@ -0,0 +1,195 @@
+'''
+Author: leovt (Leonhard Vogt)
+License: GNU GENERAL PUBLIC LICENSE - Version 3, 29 June 2007
+
+Batch rendering of small offscreen images on a pool of processes
+
+Each worker process creates its own headless context with the render
+program of glhelper.py and a Framebuffer, the way render_to_texture
+renders into the 30x20 framebuffer. The pixels are read back directly
+into a slot of a shared memory block, only slot numbers are pickled.
+
+    with RenderFarm(30, 20) as farm:
+        for pixels in farm.render(jobs):
+            ...
+
+A job is the vertex data of the triangles to draw, as accepted by
+ShaderProgram.send_data. Without a GPU the contexts use Mesa llvmpipe,
+which then renders on one thread per process so the processes do not
+compete for the cores.
+
+    python renderfarm.py --jobs 2000 --workers 1,2,4
+
+prints the throughput for each number of workers.
+'''
+
+import os
+import sys
+import time
+import ctypes
+import argparse
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+
+import pyglet
+# must be set before pyglet.gl or pyglet.window are imported
+pyglet.options['headless'] = True
+pyglet.options['shadow_window'] = False
+from pyglet import gl
+
+import glhelper
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# state of a worker process, set up by _init_worker
+_worker = None
+
+
+def _init_worker(memory_name, width, height, clear_color):
+    global _worker
+    # each process is single threaded in llvmpipe, the pool provides the parallelism
+    os.environ.setdefault('LP_NUM_THREADS', '1')
+    window = pyglet.window.Window(width=width, height=height, visible=False)
+    glhelper.window = window
+    program = glhelper.setup_render_program()
+    target = glhelper.Framebuffer(width, height)
+    memory = shared_memory.SharedMemory(memory_name)
+    _worker = (window, program, target, memory, clear_color)
+
+
+def _render(slot, vertices):
+    window, program, target, memory, clear_color = _worker
+    first = program.send_data(vertices)
+    size = target.width * target.height * 4
+    with target:
+        glhelper.current_state().set_clear_color(*clear_color)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+        with program:
+            gl.glDrawArrays(gl.GL_TRIANGLES, first, program.vertex_count)
+        pixels = (ctypes.c_ubyte * size).from_buffer(memory.buf, slot * size)
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 4)
+        gl.glReadPixels(0, 0, target.width, target.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, pixels)
+        # the shared memory can only be closed when no ctypes array refers to it
+        del pixels
+    return slot
+
+
+class RenderFarm:
+    '''
+    A pool of worker processes rendering jobs into width x height images.
+
+    At most slots jobs are in flight, each owning a slot of the shared
+    memory block until its pixels have been copied out.
+    '''
+    def __init__(self, width=glhelper.FB_WIDTH, height=glhelper.FB_HEIGHT, workers=None, slots=None,
+                 clear_color=(0.5, 0.6, 0.7, 1.0)):
+        self.width = width
+        self.height = height
+        self.workers = workers or os.cpu_count()
+        self.slots = slots or 4 * self.workers
+        self.image_size = width * height * 4
+        self.memory = shared_memory.SharedMemory(create=True, size=self.image_size * self.slots)
+
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(self.workers, _init_worker,
+                                 (self.memory.name, width, height, clear_color))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+
+    def _pixels(self, slot):
+        view = self.memory.buf[slot * self.image_size:(slot + 1) * self.image_size]
+        try:
+            if numpy is None:
+                return bytes(view)
+            return numpy.frombuffer(view, numpy.uint8).reshape(self.height, self.width, 4).copy()
+        finally:
+            view.release()
+
+    def render(self, jobs):
+        '''
+        Render the jobs on the workers and yield the pixels of each, in
+        the order of the jobs, as (height, width, 4) numpy arrays (or
+        bytes without numpy). Rows are in GL order, bottom row first.
+        '''
+        free = list(range(self.slots))
+        in_flight = collections.deque()
+        jobs = iter(jobs)
+        while True:
+            while free:
+                vertices = next(jobs, None)
+                if vertices is None:
+                    break
+                slot = free.pop()
+                in_flight.append((slot, self.pool.apply_async(_render, (slot, vertices))))
+            if not in_flight:
+                return
+            slot, result = in_flight.popleft()
+            try:
+                result.get()
+                pixels = self._pixels(slot)
+            finally:
+                free.append(slot)
+            yield pixels
+
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.memory.close()
+        self.memory.unlink()
+
+
+def random_triangles(count, seed):
+    '''
+    Return count triangles with pseudo random corners and colors.
+    '''
+    vertices = []
+    for i in range(3 * count):
+        a = (seed * 7919 + i * 104729) % 1000003
+        vertices.append((((a % 181) / 90.0 - 1.0, (a % 173) / 86.5 - 1.0),
+                         ((a % 7) / 6.0, (a % 11) / 10.0, (a % 13) / 12.0, 1.0)))
+    return vertices
+
+
+def int_list(text):
+    return [int(item) for item in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--triangles', type=int, default=20, help='triangles per job')
+    parser.add_argument('--workers', type=int_list, default=[os.cpu_count()],
+                        help='comma separated numbers of worker processes')
+    parser.add_argument('--size', default='%dx%d' % (glhelper.FB_WIDTH, glhelper.FB_HEIGHT),
+                        help='image size, e.g. 30x20')
+    args = parser.parse_args()
+    width, height = (int(n) for n in args.size.split('x'))
+
+    jobs = [random_triangles(args.triangles, seed) for seed in range(args.jobs)]
+    for workers in args.workers:
+        with RenderFarm(width, height, workers) as farm:
+            # the first image includes starting the workers
+            start = time.perf_counter()
+            results = farm.render(jobs)
+            next(results)
+            started = time.perf_counter()
+            count = 1 + sum(1 for pixels in results)
+            end = time.perf_counter()
+        sys.stdout.write('%d workers: %d images in %.3f s (%.1f images/s, startup %.3f s)\n' % (
+            workers, count, end - start, (count - 1) / (end - started), started - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+Author: leovt (Leonhard Vogt)
+License: GNU GENERAL PUBLIC LICENSE - Version 3, 29 June 2007
+
+Demand driven redrawing for the pyglet examples
+
+Only depends on pyglet, so the single file examples can use it
+without pulling in glhelper.
+'''
+
+import math
+import time
+import collections
+import pyglet
+
+
+class FrameScheduler:
+    '''
+    Redraw a window only when something changed.
+
+    invalidate() marks the scene dirty and schedules a single redraw, at
+    once or at the earliest time allowed by max_fps. Nothing is scheduled
+    while the scene is clean, so an idle process sleeps in the event loop.
+    With vsync enabled the flip after each redraw presents the frame at
+    the next refresh. Resizing or exposing the window invalidates it.
+
+    report() compares the time spent drawing with the frame-time budget,
+    which defaults to the max_fps interval or 1/60 s.
+    '''
+    def __init__(self, window, max_fps=None, budget=None, history=120):
+        self.window = window
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.budget = budget or self.min_interval or 1 / 60
+        self.dirty = False
+        self.scheduled = False
+        self.last_frame = -math.inf
+        self.frames = 0
+        self.over_budget = 0
+        self.draw_times = collections.deque(maxlen=history)
+        window.push_handlers(on_expose=self.invalidate,
+                             on_resize=lambda width, height: self.invalidate())
+
+    def invalidate(self):
+        self.dirty = True
+        if not self.scheduled:
+            self.scheduled = True
+            delay = max(0.0, self.last_frame + self.min_interval - time.perf_counter())
+            pyglet.clock.schedule_once(self._redraw, delay)
+
+    def _redraw(self, dt):
+        self.scheduled = False
+        if not self.dirty:
+            return
+        self.dirty = False
+        self.last_frame = start = time.perf_counter()
+        self.window.switch_to()
+        self.window.dispatch_event('on_draw')
+        draw_time = time.perf_counter() - start
+        self.window.flip()
+
+        self.frames += 1
+        self.draw_times.append(draw_time)
+        if draw_time > self.budget:
+            self.over_budget += 1
+
+
+    def run(self):
+        '''
+        Run the pyglet event loop without its periodic redraw.
+        '''
+        self.invalidate()
+        pyglet.app.run(None)
+
+
+    def report(self):
+        '''
+        Return the frame count and the recent draw times against the budget.
+        '''
+        times = self.draw_times or [0.0]
+        return {
+            'frames': self.frames,
+            'budget_ms': 1000 * self.budget,
+            'mean_ms': 1000 * sum(times) / len(times),
+            'max_ms': 1000 * max(times),
+            'over_budget': self.over_budget,
+        }
+
+    def __str__(self):
+        return ('{frames} frames, draw time mean {mean_ms:.3f} ms, max {max_ms:.3f} ms, '
+                '{over_budget} over the {budget_ms:.1f} ms budget'.format(**self.report()))
@@ -8,6 +8,7 @@ Example code for using glsl and vertex buffer objects with pyglet
 import pyglet
 from pyglet import gl
 import ctypes
+from scheduler import FrameScheduler
 
 vertexbuffer = gl.GLuint(0)
 
@@ -119,8 +120,7 @@ def main():
     setup_vertexbuffer(program)
     print('OpenGL Version {}'.format(window.context.get_info().get_version()))
     window.on_draw = draw
-    pyglet.clock.schedule_interval(lambda dt:None, 0.01)
-    pyglet.app.run()
+    FrameScheduler(window).run()
 
 
 if __name__ == '__main__':